@@ -1,7 +1,9 @@
+import datetime
+import json
 import logging
 import os
+import threading
 import time
-import requests
 from google.cloud import ndb
 from google.cloud import secretmanager
 from flask import Flask, g, request, Response
@@ -20,17 +22,124 @@ else:
     secretClient = secretmanager.SecretManagerServiceClient.from_service_account_json(keyfile)
 
 
-def secret(secret_id, version_id="latest"):
+# Secret cache
+# Secrets are cached process-wide for SECRET_CACHE_TTL seconds and refreshed
+# in a background thread once they enter the last SECRET_REFRESH_AHEAD seconds
+# of their lifetime, so the hot path never waits for Secret Manager.
+# If Secret Manager fails, the last known value is served (stale-on-error).
+SECRET_CACHE_TTL = 60 * 60
+SECRET_REFRESH_AHEAD = 5 * 60
+
+# Pin individual secrets to a specific version instead of "latest",
+# e.g. {"TYPEWORLD_API_KEY": "3"}. Pinned versions are immutable and never expire.
+SECRET_VERSIONS = {}
+
+# Local provider: environment variables `AWESOMEFONTS_SECRET_<secret_id>` or files
+# in `.secrets/<secret_id>` take precedence over Secret Manager, so secrets
+# kept there don’t depend on Secret Manager being reachable at all.
+SECRET_ENVIRONMENT_PREFIX = "AWESOMEFONTS_SECRET_"
+SECRET_LOCAL_FOLDER = os.path.join(os.path.dirname(__file__), "..", ".secrets")
+
+_secretCache = {}
+_secretRefreshing = set()
+_secretLock = threading.Lock()
+
+
+def localSecret(secret_id):
+    """
+    Return a secret from the environment or the local secrets folder, or None.
+    """
+    if SECRET_ENVIRONMENT_PREFIX + secret_id in os.environ:
+        return os.environ[SECRET_ENVIRONMENT_PREFIX + secret_id]
+
+    path = os.path.join(SECRET_LOCAL_FOLDER, secret_id)
+    if os.path.isfile(path):
+        with open(path, "r") as f:
+            return f.read().strip()
+
+
+def fetchSecret(secret_id, version_id="latest"):
     """
     Access Google Cloud Secrets
     https://cloud.google.com/secret-manager/docs/creating-and-accessing-secrets#access
     """
+
+    local = localSecret(secret_id)
+    if local is not None:
+        return local
+
     name = f"projects/293955791033/secrets/{secret_id}/versions/{version_id}"
     response = secretClient.access_secret_version(request={"name": name})
     payload = response.payload.data.decode("UTF-8")
     return payload
 
 
+def _refreshSecret(secret_id, version_id):
+    cacheKey = (secret_id, version_id)
+    try:
+        payload = fetchSecret(secret_id, version_id)
+        with _secretLock:
+            _secretCache[cacheKey] = (payload, time.time())
+    except Exception:
+        logging.exception(f"Refreshing secret {secret_id} failed, serving stale value")
+    finally:
+        with _secretLock:
+            _secretRefreshing.discard(cacheKey)
+
+
+def secret(secret_id, version_id="latest"):
+    """
+    Return a secret, served from the process-wide secret cache.
+    """
+
+    if version_id == "latest" and secret_id in SECRET_VERSIONS:
+        version_id = SECRET_VERSIONS[secret_id]
+    cacheKey = (secret_id, version_id)
+
+    with _secretLock:
+        cached = _secretCache.get(cacheKey)
+
+    if cached:
+        payload, fetched = cached
+        age = time.time() - fetched
+
+        # Pinned versions never change
+        if version_id != "latest" or age < SECRET_CACHE_TTL - SECRET_REFRESH_AHEAD:
+            return payload
+
+        # About to expire: refresh in the background, serve cached value meanwhile
+        if age < SECRET_CACHE_TTL:
+            with _secretLock:
+                if cacheKey not in _secretRefreshing:
+                    _secretRefreshing.add(cacheKey)
+                    threading.Thread(target=_refreshSecret, args=(secret_id, version_id), daemon=True).start()
+            return payload
+
+    # Not cached or expired: fetch synchronously
+    try:
+        payload = fetchSecret(secret_id, version_id)
+    except Exception:
+        if cached:
+            logging.exception(f"Fetching secret {secret_id} failed, serving stale value")
+            return cached[0]
+        raise
+
+    with _secretLock:
+        _secretCache[cacheKey] = (payload, time.time())
+
+    return payload
+
+
+def invalidateSecret(secret_id=None):
+    """
+    Drop one or all secrets from the secret cache, e.g. after rotating a secret.
+    """
+    with _secretLock:
+        for cacheKey in list(_secretCache.keys()):
+            if secret_id is None or cacheKey[0] == secret_id:
+                del _secretCache[cacheKey]
+
+
 # Pre-initialize datastore context
 def ndb_wsgi_middleware(wsgi_app):
     def middleware(environ, start_response):
@@ -44,20 +153,102 @@ app = Flask(__name__)
 app.wsgi_app = ndb_wsgi_middleware(app.wsgi_app)  # Wrap the app in middleware.
 app.secret_key = secret("FLASK_SECRET_KEY")
 app.config.update(SESSION_COOKIE_NAME="awesomefonts")
-app.config["modules"] = ["__main__"]
+
+# Session backend: "cookie" keeps small sessions in the signed session cookie,
+# "datastore" keeps every session in a classes.Session entity.
+# Cookie sessions that grow beyond SESSION_COOKIE_MAX_BYTES move to the Datastore.
+app.config["SESSION_BACKEND"] = "cookie"
+app.config["SESSION_COOKIE_MAX_BYTES"] = 2048
+# Datastore sessions expire SESSION_EXPIRY after they were last touched.
+# Sessions that are only read get touched at most once per SESSION_TOUCH_INTERVAL.
+app.config["SESSION_EXPIRY"] = datetime.timedelta(days=30)
+app.config["SESSION_TOUCH_INTERVAL"] = datetime.timedelta(days=1)
 
 # Local imports
 # happen here because of circular imports,
 from . import account  # noqa: E402,F401
+from . import blobs  # noqa: E402,F401
 from . import classes  # noqa: E402
 from . import checkout  # noqa: E402,F401
 from . import definitions  # noqa: E402
+from . import emailverification  # noqa: E402,F401
 from . import helpers  # noqa: E402
 from . import hypertext  # noqa: E402
+from . import jobs  # noqa: E402
+from . import outbound  # noqa: E402
+from . import outbox  # noqa: E402,F401
+from . import vatid  # noqa: E402,F401
 from . import web  # noqa: E402,F401
 from . import typeworldapi  # noqa: E402,F401
 
 
+class CookieSession(object):
+    """
+    Session data kept in Flask’s signed session cookie,
+    with the same get()/set() interface as classes.Session.
+    """
+
+    def __init__(self, data=None):
+        self.data = data or {}
+        self.datastoreSession = None
+
+    def get(self, key):
+        if self.datastoreSession:
+            return self.datastoreSession.get(key)
+        if key in self.data:
+            return self.data[key]
+
+    def set(self, key, value):
+        if self.datastoreSession:
+            return self.datastoreSession.set(key, value)
+
+        self.data[key] = value
+
+        # Too large for a cookie, move to the Datastore
+        if len(json.dumps(self.data, separators=(",", ":"))) > app.config["SESSION_COOKIE_MAX_BYTES"]:
+            self.datastoreSession = classes.Session(data=self.data)
+            self.datastoreSession.putnow()
+            flaskSession.pop("data", None)
+            flaskSession["sessionID"] = self.datastoreSession.key.urlsafe().decode()
+            g.session = self.datastoreSession
+        else:
+            flaskSession["data"] = self.data
+
+
+def loadSession():
+    """
+    Return the current visitor’s session from the configured session backend.
+    """
+
+    if "sessionID" in flaskSession and flaskSession["sessionID"]:
+        session = ndb.Key(urlsafe=flaskSession["sessionID"].encode()).get(read_consistency=ndb.STRONG)
+        if session and not session.expired():
+            if session.touched and session.touched < helpers.now() - app.config["SESSION_TOUCH_INTERVAL"]:
+                session.touch()
+            return session
+        flaskSession.pop("sessionID")
+
+    if app.config["SESSION_BACKEND"] == "cookie":
+        return CookieSession(flaskSession.get("data"))
+
+    # Entity gets written on first set()
+    return classes.Session()
+
+
+def loginCode():
+    """
+    Random `state` for the Type.World Sign-In, kept in the session cookie
+    so that rendering the sign-in button doesn’t need a session write.
+    """
+    if not flaskSession.get("loginCode"):
+        resetLoginCode()
+    return flaskSession["loginCode"]
+
+
+def resetLoginCode():
+    flaskSession["loginCode"] = helpers.Garbage(40)
+
+
 def tooltip(name, text):
 
     tooltips = g.session.get("tooltips") or []
@@ -78,30 +269,23 @@ def before_request():
     g.user = None
     g.admin = None
     g.session = None
-    g.ndb_puts = []
+    g.ndb_puts = {}
     g.html = hypertext.HTML()
 
+    # Process jobs left over from previous processes
+    jobs.startWorker()
+
     if request.endpoint != "static":
 
         # Session
         # flaskSession.permanent = True
-        if "sessionID" in flaskSession and flaskSession["sessionID"]:
-            sessionID = flaskSession["sessionID"]
-            g.session = ndb.Key(urlsafe=sessionID.encode()).get(read_consistency=ndb.STRONG)
-        else:
-            g.session = classes.Session()
-            g.session.put()
-            flaskSession["sessionID"] = g.session.key.urlsafe().decode()
-
-        # Set random loginCode
-        if not g.session.get("loginCode"):
-            g.session.set("loginCode", helpers.Garbage(40))
+        g.session = loadSession()
 
         # Catch Type.World Sign In here
-        if g.form._get("code") and g.form._get("state") and g.form._get("state") == g.session.get("loginCode"):
+        if g.form._get("code") and g.form._get("state") and g.form._get("state") == flaskSession.get("loginCode"):
 
             # Get token with code
-            getTokenResponse = requests.post(
+            getTokenResponse = outbound.post(
                 definitions.TYPEWORLD_GETTOKEN_URL,
                 data={
                     "grant_type": "authorization_code",
@@ -114,9 +298,10 @@ def before_request():
 
             # Redeem token for user data
             if getTokenResponse["status"] == "success":
-                getUserDataResponse = requests.post(
+                getUserDataResponse = outbound.post(
                     definitions.TYPEWORLD_GETUSERDATA_URL,
                     headers={"Authorization": "Bearer " + getTokenResponse["access_token"]},
+                    idempotent=True,
                 ).json()
 
                 # Create user if necessary and save token
@@ -124,6 +309,7 @@ def before_request():
                     user = classes.User.get_or_insert(getUserDataResponse["userdata"]["user_id"])
                     user.typeWorldToken = getTokenResponse["access_token"]
                     user.put()
+                    user.cacheUserdata(getUserDataResponse)
                     g.user = user
 
                     # Fetch user data
@@ -142,20 +328,24 @@ def before_request():
                 g.user = classes.User.get_or_insert(g.session.get("userID"))
 
             # Test if token is still valid
-            # Pull fresh user data from endpoint
+            # Pull user data from endpoint (cached for definitions.USERDATA_CACHE_TTL)
             # otherwise sign user out
-            #
-            # Performance-wise it's not good to do this here on every page load.
-            # Do this once per session or when you expect updates
-            # (such as after a return from the user editing his data on type.world)
             if g.user:
+
+                # Returning from the user editing their data on type.world, so pull fresh data
+                if g.form._get("redirect_reason") == "userdata_edit":
+                    g.user.invalidateUserdata()
+                    g.html.SCRIPT()
+                    g.html.T("window.history.replaceState('', '', window.location.href.split('?')[0]);")
+                    g.html._SCRIPT()
+
                 try:
                     response = g.user.userdata()
                     if response["status"] == "fail":
                         g.user.typeWorldToken = None
                         g.user.put()
                         g.user = None
-                        g.session.set("loginCode", helpers.Garbage(40))
+                        resetLoginCode()
                     else:
                         # Set data here instead of polling each time separately
                         g.user.data = response
@@ -189,11 +379,8 @@ def after_request(response):
             html = html.replace("---replace---", response.get_data().decode())
             response.set_data(html)
 
-    if g.ndb_puts:
-        ndb.put_multi(g.ndb_puts)
-        for object in g.ndb_puts:
-            object._cleanupPut()
-        g.ndb_puts = []
+    web.flushPuts()
+    jobs.afterRequest()
 
     return response
 
@@ -218,7 +405,7 @@ def index():
         g.html._P()
 
     googleFontsFamilies = []
-    for product in classes.Product.query().fetch():
+    for product in classes.catalog().products:
         product.container("overview")
         string = product.name
         if product.googleFontsFamilySuffix:
@@ -278,12 +465,36 @@ def logout():
     g.admin = False
 
     # Set random loginCode
-    g.session.set("loginCode", helpers.Garbage(40))
+    resetLoginCode()
     g.session.set("userID", None)
 
     return "<script>window.location.reload();</script>"
 
 
+@app.route("/cron/sweepsessions", methods=["GET"])
+def cron_sweepsessions():
+
+    # Only App Engine Cron may call this
+    if request.headers.get("X-Appengine-Cron") != "true":
+        return Response("forbidden", 403, mimetype="text/plain")
+
+    deleted = classes.Session.sweep(helpers.now() - app.config["SESSION_EXPIRY"])
+
+    return Response(f"deleted {deleted}", 200, mimetype="text/plain")
+
+
+@app.route("/cron/sweepjobs", methods=["GET"])
+def cron_sweepjobs():
+
+    # Only App Engine Cron may call this
+    if request.headers.get("X-Appengine-Cron") != "true":
+        return Response("forbidden", 403, mimetype="text/plain")
+
+    deleted = jobs.Job.sweep(helpers.now() - datetime.timedelta(seconds=jobs.RETENTION))
+
+    return Response(f"deleted {deleted}", 200, mimetype="text/plain")
+
+
 @app.route("/resettooltips", methods=["GET"])
 def resettooltips():
 
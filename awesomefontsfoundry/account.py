@@ -1,13 +1,11 @@
 # project
 import awesomefontsfoundry
+from awesomefontsfoundry import classes
 
 # other
 from flask import g
 
 
-awesomefontsfoundry.app.config["modules"].append("account")
-
-
 def printUserData(userdata=None):
 
     if not userdata:
@@ -18,7 +16,14 @@ def printUserData(userdata=None):
         g.html.T(userdata["scope"][scope]["name"])
         if "edit_uri" in userdata["scope"][scope]:
             g.html.T(" ")
-            g.html.A(onclick=f"edit('{userdata['scope'][scope]['edit_uri']}', window.location.href);")
+            # Mark the way back, so that the fresh user data gets pulled on return
+            g.html.A(
+                onclick=(
+                    "var url = new URL(window.location.href);"
+                    " url.searchParams.set('redirect_reason', 'userdata_edit');"
+                    f" edit('{userdata['scope'][scope]['edit_uri']}', url.href);"
+                )
+            )
             g.html.T('(<span class="material-icons-outlined">edit</span> Edit)')
             g.html._A()
         g.html._H3()
@@ -58,8 +63,7 @@ def account():
         g.html.H1()
         g.html.T("Purchased Fonts")
         g.html._H1()
-        for key in g.user.purchasedProductKeys:
-            product = key.get()
+        for product in classes.Product.getMulti(g.user.purchasedProductKeys):
             product.container("accountview")
 
         g.html.mediumSeparator()
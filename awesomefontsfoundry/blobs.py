@@ -0,0 +1,305 @@
+# project
+import awesomefontsfoundry
+
+# other
+import base64
+import hashlib
+import os
+import tempfile
+from google.cloud import ndb
+
+# Content-addressed storage for binary files (such as fonts) outside of the entities
+# that reference them. Files are identified by the SHA-256 hash of their content
+# and stored in chunks, so they aren’t bound by the 1 MiB entity size limit
+# and only get loaded when their bytes are actually needed.
+#
+# By default, files are stored in the Datastore. Setting app.config["BLOB_FOLDER"]
+# (or the AWESOMEFONTS_BLOB_FOLDER environment variable) stores them in a local folder
+# instead, for running locally and for tests.
+
+CHUNK_SIZE = 512 * 1024
+
+awesomefontsfoundry.app.config["BLOB_FOLDER"] = os.getenv("AWESOMEFONTS_BLOB_FOLDER")
+
+# Base64-encoded file contents are cached on local disk, shared by all worker processes
+# of an instance, and evicted least-recently-used first beyond BASE64_CACHE_MAX_BYTES.
+# Note that /tmp on App Engine counts against the instance’s memory.
+awesomefontsfoundry.app.config["BASE64_CACHE_FOLDER"] = os.path.join(tempfile.gettempdir(), "awesomefonts-base64")
+awesomefontsfoundry.app.config["BASE64_CACHE_MAX_BYTES"] = 64 * 1024 * 1024
+
+
+def contentHash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def fileFormat(filename):
+    return filename.split(".")[-1].lower()
+
+
+class Blob(ndb.Model):
+    # Key ID is the content hash
+    size = ndb.IntegerProperty(indexed=False)
+    chunks = ndb.IntegerProperty(indexed=False)
+
+
+class BlobChunk(ndb.Model):
+    # Key ID is "<content hash>-<chunk index>"
+    data = ndb.BlobProperty()
+
+
+class DatastoreBlobStore(object):
+    def exists(self, digest):
+        return ndb.Key(Blob, digest).get() is not None
+
+    def put(self, data):
+        digest = contentHash(data)
+        if not self.exists(digest):
+            chunks = [
+                BlobChunk(id=f"{digest}-{i}", data=data[start : start + CHUNK_SIZE])  # noqa E203
+                for i, start in enumerate(range(0, len(data), CHUNK_SIZE))
+            ]
+            ndb.put_multi(chunks, use_cache=False)
+            # Write the manifest last, so a blob only exists once all of its chunks do
+            Blob(id=digest, size=len(data), chunks=len(chunks)).put()
+        return digest
+
+    def size(self, digest):
+        blob = ndb.Key(Blob, digest).get()
+        if blob:
+            return blob.size
+
+    def iterate(self, digest, start=0, end=None):
+        blob = ndb.Key(Blob, digest).get()
+        if blob is None:
+            raise KeyError(digest)
+        if end is None:
+            end = blob.size
+        if start >= end:
+            return
+        # Only fetch the chunks that overlap with the requested range
+        for i in range(start // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1):
+            # Bypass the context cache so that chunks don’t pile up in memory
+            data = ndb.Key(BlobChunk, f"{digest}-{i}").get(use_cache=False).data
+            offset = i * CHUNK_SIZE
+            yield data[max(start - offset, 0) : end - offset]  # noqa E203
+
+    def read(self, digest):
+        return b"".join(self.iterate(digest))
+
+    def delete(self, digest):
+        blob = ndb.Key(Blob, digest).get()
+        if blob:
+            ndb.delete_multi(
+                [ndb.Key(Blob, digest)] + [ndb.Key(BlobChunk, f"{digest}-{i}") for i in range(blob.chunks)]
+            )
+
+
+class LocalBlobStore(object):
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def put(self, data):
+        digest = contentHash(data)
+        if not self.exists(digest):
+            temp = self.path(digest) + f".{os.getpid()}.tmp"
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, self.path(digest))
+        return digest
+
+    def size(self, digest):
+        if self.exists(digest):
+            return os.path.getsize(self.path(digest))
+
+    def iterate(self, digest, start=0, end=None):
+        if not self.exists(digest):
+            raise KeyError(digest)
+        if end is None:
+            end = self.size(digest)
+        with open(self.path(digest), "rb") as f:
+            f.seek(start)
+            position = start
+            while position < end:
+                chunk = f.read(min(CHUNK_SIZE, end - position))
+                if not chunk:
+                    break
+                position += len(chunk)
+                yield chunk
+
+    def read(self, digest):
+        if not self.exists(digest):
+            raise KeyError(digest)
+        with open(self.path(digest), "rb") as f:
+            return f.read()
+
+    def delete(self, digest):
+        if self.exists(digest):
+            os.remove(self.path(digest))
+
+
+class Base64Cache(object):
+    def __init__(self, folder, maxBytes):
+        self.folder = folder
+        self.maxBytes = maxBytes
+        os.makedirs(folder, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest)
+
+    def iterate(self, file):
+        """
+        Yield the base64-encoded content of a file reference in chunks,
+        from the cache if possible, otherwise encoding it and filling the cache on the way.
+        """
+
+        # Legacy file without hash
+        if "hash" not in file:
+            yield from base64Chunks(iterate(file))
+            return
+
+        path = self.path(file["hash"])
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            f = None
+
+        if f:
+            # Mark as recently used
+            os.utime(path)
+            with f:
+                while True:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            return
+
+        temp = path + f".{os.getpid()}.tmp"
+        complete = False
+        try:
+            with open(temp, "wb") as f:
+                for chunk in base64Chunks(iterate(file)):
+                    f.write(chunk)
+                    yield chunk
+            os.replace(temp, path)
+            complete = True
+        finally:
+            if not complete and os.path.exists(temp):
+                os.remove(temp)
+        self.evict()
+
+    def populate(self, file):
+        for chunk in self.iterate(file):
+            pass
+
+    def evict(self):
+        files = []
+        for name in os.listdir(self.folder):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum([x[1] for x in files])
+        for mtime, size, name in sorted(files):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def base64Chunks(chunks):
+    """
+    Base64-encode a sequence of byte chunks chunk by chunk.
+    Each chunk is cut to a multiple of 3 bytes so that the encoded parts concatenate without padding.
+    """
+    rest = b""
+    for chunk in chunks:
+        data = rest + chunk
+        cut = len(data) - len(data) % 3
+        rest = data[cut:]
+        if cut:
+            yield base64.b64encode(data[:cut])
+    if rest:
+        yield base64.b64encode(rest)
+
+
+_store = None
+_base64Cache = None
+
+
+def store():
+    global _store
+    if _store is None:
+        if awesomefontsfoundry.app.config["BLOB_FOLDER"]:
+            _store = LocalBlobStore(awesomefontsfoundry.app.config["BLOB_FOLDER"])
+        else:
+            _store = DatastoreBlobStore()
+    return _store
+
+
+def base64Cache():
+    global _base64Cache
+    if _base64Cache is None:
+        _base64Cache = Base64Cache(
+            awesomefontsfoundry.app.config["BASE64_CACHE_FOLDER"],
+            awesomefontsfoundry.app.config["BASE64_CACHE_MAX_BYTES"],
+        )
+    return _base64Cache
+
+
+def storeFile(filename, data):
+    """
+    Store a file’s content and return the reference to keep in an entity.
+    """
+    return {
+        "filename": filename,
+        "hash": store().put(data),
+        "size": len(data),
+        "format": fileFormat(filename),
+    }
+
+
+def read(file):
+    """
+    Return the content of a file reference as bytes.
+    """
+    if "stream" in file:
+        return file["stream"]
+    return store().read(file["hash"])
+
+
+def iterate(file, start=0, end=None):
+    """
+    Yield the content of a file reference in chunks,
+    optionally only the bytes from `start` up to (not including) `end`.
+    """
+    if "stream" in file:
+        yield file["stream"][start:end]
+    else:
+        yield from store().iterate(file["hash"], start, end)
+
+
+def fileHash(file):
+    if "hash" in file:
+        return file["hash"]
+    return contentHash(file["stream"])
+
+
+def fileSize(file):
+    if "size" in file:
+        return file["size"]
+    return len(file["stream"])
@@ -1,7 +1,50 @@
 import awesomefontsfoundry
-from awesomefontsfoundry import classes, definitions, account, helpers
-from flask import g
-import requests
+from awesomefontsfoundry import classes, definitions, account, helpers, jobs, outbound, web
+from flask import abort, g
+from google.cloud import ndb
+
+# Cart items are kept in the session as {"key": <urlsafe product key>, "quantity": 1, "license": "ofl"}
+DEFAULT_LICENSE = "ofl"
+
+
+def cartItems():
+    """
+    Return the items of the session cart.
+    Carts from before carts held product keys (a list of product names) are migrated.
+    """
+    items = []
+    migrated = False
+    for item in g.session.get("cart") or []:
+        if isinstance(item, str):
+            migrated = True
+            product = classes.catalog().byName.get(item)
+            if product:
+                items.append({"key": product.key.urlsafe().decode(), "quantity": 1, "license": DEFAULT_LICENSE})
+        else:
+            items.append(item)
+    if migrated:
+        g.session.set("cart", items)
+    return items
+
+
+def cartProducts(items):
+    """
+    Resolve cart items to (item, product) pairs in one batch,
+    skipping products that don’t exist anymore.
+    """
+    keys = [ndb.Key(urlsafe=x["key"].encode()) for x in items]
+    products = {x.key: x for x in classes.Product.getMulti(keys)}
+    return [(item, products[key]) for item, key in zip(items, keys) if key in products]
+
+
+def productKey(urlsafe):
+    try:
+        key = ndb.Key(urlsafe=urlsafe.encode())
+    except Exception:
+        return abort(400)
+    if key.kind() != "Product":
+        return abort(400)
+    return key
 
 
 @awesomefontsfoundry.app.route("/cart", methods=["GET", "POST"])
@@ -13,13 +56,12 @@ def cart():
     g.html.T("Shopping Cart")
     g.html._H1()
 
-    products = g.session.get("cart")
+    products = cartProducts(cartItems())
     sum = 0
     if products:
-        for productName in products:
-            product = classes.Product.query(classes.Product.name == productName).get()
-            product.container("cartview")
-            sum += product.price
+        for item, product in products:
+            product.container("cartview", {"quantity": item["quantity"]})
+            sum += product.price * item["quantity"]
 
         g.html.DIV(class_="clear cart")
         g.html.DIV(class_="floatleft font")
@@ -70,7 +112,7 @@ def checkout():
             onclick=(
                 f"login('{definitions.TYPEWORLD_SIGNIN_URL}',"
                 f" '{awesomefontsfoundry.secret('TYPEWORLD_SIGNIN_CLIENTID')}', window.location.href,"
-                f" '{definitions.TYPEWORLD_SIGNIN_SCOPE}', '{g.session.get('loginCode')}')"
+                f" '{definitions.TYPEWORLD_SIGNIN_SCOPE}', '{awesomefontsfoundry.loginCode()}')"
             ),
         )
         g.html.T('<span class="material-icons-outlined">login</span> Sign In with Type.World')
@@ -135,18 +177,89 @@ def done():
     g.html.T('Additionally, you can download the fonts via the <a href="/account">User Account</a>')
     g.html._P()
 
+    if g.session.get("checkoutJobs"):
+        web.container("checkoutStatus", {"jobs": g.session.get("checkoutJobs")})
+
     g.html._DIV()  # .content
 
     return g.html.generate()
 
 
+@web.unboundView
+def checkoutStatus(parameters={}, directCallParameters={}):
+    """
+    Status of the Type.World subscription jobs of the last checkout, reloading itself until they’re finished
+    """
+
+    # Only jobs of this session’s checkout
+    jobIDs = [x for x in parameters.get("jobs", []) if x in (g.session.get("checkoutJobs") or [])]
+
+    jobList = []
+    for job in ndb.get_multi([ndb.Key(jobs.Job, x) for x in jobIDs]):
+        # Help the worker along while the buyer is waiting
+        if job and not job.finished() and job.due <= helpers.now():
+            job = jobs.run(job.key)
+        jobList.append(job)
+
+    g.html.P()
+    if any([x and x.status == jobs.FAILED for x in jobList]):
+        g.html.T(
+            "Unfortunately, we couldn’t set up your Type.World subscription."
+            " We’ve been notified and will get back to you."
+        )
+    elif all([x and x.status == jobs.DONE for x in jobList]):
+        g.html.T('<span class="material-icons-outlined">done</span> Your Type.World subscription is ready.')
+    else:
+        g.html.T("Setting up your Type.World subscription …")
+        identifier = web.encodeDataContainer(None, "checkoutStatus", parameters)
+        g.html.SCRIPT()
+        g.html.T(f"setTimeout(function () {{ reload($('.{identifier}').first()); }}, 2000);")
+        g.html._SCRIPT()
+    g.html._P()
+
+
+@jobs.task
+def updateSubscription(subscriptionURL, targetUserEmail, checkoutID):
+    parameters = {
+        "APIKey": awesomefontsfoundry.secret("TYPEWORLD_API_KEY"),
+        "subscriptionURL": subscriptionURL,
+    }
+    print("updateSubscription")
+    response = outbound.post("https://api.type.world/v1/updateSubscription", data=parameters, idempotent=True)
+    response.raise_for_status()
+    print("updateSubscription response", response.json())
+    if response.json()["response"] != "success":
+        raise ValueError(f"updateSubscription: {response.json()}")
+
+    # Invite user to share subscription only once the subscription is updated
+    jobs.enqueue(
+        "inviteUserToSubscription",
+        f"{checkoutID}-inviteUserToSubscription",
+        subscriptionURL=subscriptionURL,
+        targetUserEmail=targetUserEmail,
+    )
+
+
+@jobs.task
+def inviteUserToSubscription(subscriptionURL, targetUserEmail):
+    parameters = {
+        "targetUserEmail": targetUserEmail,
+        "APIKey": awesomefontsfoundry.secret("TYPEWORLD_API_KEY"),
+        "subscriptionURL": subscriptionURL,
+    }
+    print("inviteUserToSubscription")
+    response = outbound.post("https://api.type.world/v1/inviteUserToSubscription", data=parameters)
+    response.raise_for_status()
+    print("inviteUserToSubscription response", response.json())
+    if response.json()["response"] != "success":
+        raise ValueError(f"inviteUserToSubscription: {response.json()}")
+
+
 @awesomefontsfoundry.app.route("/cart/checkout", methods=["GET", "POST"])
 def cart_checkout():
 
     # Add products to user account
-    products = g.session.get("cart")
-    for productName in products:
-        product = classes.Product.query(classes.Product.name == productName).get()
+    for item, product in cartProducts(cartItems()):
         if product.key not in g.user.purchasedProductKeys:
             g.user.purchasedProductKeys.append(product.key)
 
@@ -156,33 +269,22 @@ def cart_checkout():
 
     # Type.World API Access token
     g.user.accessToken = helpers.Garbage(40)
-    g.user.put()
+    # Written right away, type.world calls back for the subscription as soon as the job runs
+    g.user.putnow()
 
     # Reset Cart
     g.session.set("cart", [])
 
-    # Update subscription
-    url = g.user.subscriptionURL()
-    parameters = {
-        "APIKey": awesomefontsfoundry.secret("TYPEWORLD_API_KEY"),
-        "subscriptionURL": url,
-    }
-    print("updateSubscription")
-    print("updateSubscription parameters", parameters)
-    response = requests.post("https://api.type.world/v1/updateSubscription", data=parameters).json()
-    print("updateSubscription response", response)
-
-    # Invite user to share subscription
-    url = g.user.subscriptionURL()
-    parameters = {
-        "targetUserEmail": g.user.data["userdata"]["scope"]["account"]["data"]["email"],
-        "APIKey": awesomefontsfoundry.secret("TYPEWORLD_API_KEY"),
-        "subscriptionURL": url,
-    }
-    print("inviteUserToSubscription")
-    print("inviteUserToSubscription parameters", parameters)
-    response = requests.post("https://api.type.world/v1/inviteUserToSubscription", data=parameters).json()
-    print("inviteUserToSubscription response", response)
+    # Update subscription and invite user to share it, in the background
+    checkoutID = helpers.Garbage(40)
+    jobs.enqueue(
+        "updateSubscription",
+        f"{checkoutID}-updateSubscription",
+        subscriptionURL=g.user.subscriptionURL(),
+        targetUserEmail=g.user.data["userdata"]["scope"]["account"]["data"]["email"],
+        checkoutID=checkoutID,
+    )
+    g.session.set("checkoutJobs", [f"{checkoutID}-updateSubscription", f"{checkoutID}-inviteUserToSubscription"])
 
     return "<script>window.location.href='/done';</script>"
 
@@ -192,11 +294,12 @@ def cart_add():
 
     assert g.form._get("products")
 
-    products = g.session.get("cart") or []
-    for product in g.form._get("products").split(","):
-        if product not in products:
-            products.append(product)
-    g.session.set("cart", products)
+    items = cartItems()
+    for urlsafe in g.form._get("products").split(","):
+        productKey(urlsafe)
+        if urlsafe not in [x["key"] for x in items]:
+            items.append({"key": urlsafe, "quantity": 1, "license": DEFAULT_LICENSE})
+    g.session.set("cart", items)
 
     return "<script>window.location.reload();</script>"
 
@@ -206,9 +309,8 @@ def cart_remove():
 
     assert g.form._get("products")
 
-    products = g.session.get("cart") or []
-    for product in g.form._get("products").split(","):
-        products.remove(product)
-    g.session.set("cart", products)
+    urlsafes = g.form._get("products").split(",")
+    items = [x for x in cartItems() if x["key"] not in urlsafes]
+    g.session.set("cart", items)
 
     return "<script>window.location.reload();</script>"
@@ -1,12 +1,23 @@
 # project
 import awesomefontsfoundry
-from awesomefontsfoundry import web, definitions
+from awesomefontsfoundry import web, definitions, helpers, outbound
 
 # other
-import requests
+import hashlib
+import threading
+import time
+import types
 from flask import g
+from flask import session as flaskSession
+from google.cloud import ndb
 
-awesomefontsfoundry.app.config["modules"].append("classes")
+# Process-wide cache of type.world user data, keyed by token hash
+_userdataCache = {}
+_userdataCacheLock = threading.Lock()
+
+
+def tokenHash(token):
+    return hashlib.sha256(token.encode()).hexdigest()
 
 
 ###
@@ -42,16 +53,55 @@ class User(TWNDBModel):
     #     "status": "success",
     # }
 
-    def userdata(self):
-        if self.typeWorldToken:
-            response = requests.post(
-                definitions.TYPEWORLD_GETUSERDATA_URL,
-                headers={"Authorization": "Bearer " + self.typeWorldToken},
-            ).json()
-            return response
-        else:
+    def userdata(self, fresh=False):
+        """
+        Return user data from type.world, served from the user data cache
+        unless `fresh` is set.
+        Failed responses (revoked tokens) are cached for a shorter time.
+        """
+        if not self.typeWorldToken:
             return {"message": "Token is revoked", "status": "fail"}
 
+        cacheKey = tokenHash(self.typeWorldToken)
+
+        if not fresh:
+            with _userdataCacheLock:
+                cached = _userdataCache.get(cacheKey)
+            if cached and cached[1] > time.time():
+                return cached[0]
+
+        response = outbound.post(
+            definitions.TYPEWORLD_GETUSERDATA_URL,
+            headers={"Authorization": "Bearer " + self.typeWorldToken},
+            idempotent=True,
+        ).json()
+        self.cacheUserdata(response)
+        return response
+
+    def cacheUserdata(self, response):
+        if not self.typeWorldToken:
+            return
+
+        if response.get("status") == "success":
+            expires = time.time() + definitions.USERDATA_CACHE_TTL
+        else:
+            expires = time.time() + definitions.USERDATA_NEGATIVE_CACHE_TTL
+
+        with _userdataCacheLock:
+            if len(_userdataCache) >= definitions.USERDATA_CACHE_SIZE:
+                now = time.time()
+                for key in [x for x in _userdataCache if _userdataCache[x][1] <= now]:
+                    del _userdataCache[key]
+                # Still full: drop oldest entries
+                while len(_userdataCache) >= definitions.USERDATA_CACHE_SIZE:
+                    del _userdataCache[next(iter(_userdataCache))]
+            _userdataCache[tokenHash(self.typeWorldToken)] = (response, expires)
+
+    def invalidateUserdata(self):
+        if self.typeWorldToken:
+            with _userdataCacheLock:
+                _userdataCache.pop(tokenHash(self.typeWorldToken), None)
+
     def subscriptionURL(self, accessToken=False):
         protocol, root = definitions.ROOT.split("://")
         url = f"typeworld://json+{protocol}//{self.key.id()}:{self.secretKey}@{root}/typeworldapi"
@@ -72,15 +122,75 @@ class Session(TWNDBModel):
         data = self.data or {}
         data[key] = value
         self.data = data
+
+        # Sessions are created lazily on the first write
+        if self.key is None:
+            self.putnow()
+            flaskSession["sessionID"] = self.key.urlsafe().decode()
+        else:
+            self.put()
+
+    def expired(self):
+        if self.touched is None:
+            return False
+        return self.touched < helpers.now() - awesomefontsfoundry.app.config["SESSION_EXPIRY"]
+
+    def touch(self):
+        # Force a write to update `touched` even though no data changed
+        self._changed.append("touched")
         self.put()
 
+    @classmethod
+    def sweep(cls, before, batchSize=500):
+        """
+        Delete all sessions last touched before `before`, in batches of `batchSize`.
+        Returns the number of deleted sessions.
+        """
+        deleted = 0
+        cursor = None
+        while True:
+            keys, cursor, more = cls.query(cls.touched < before).fetch_page(
+                batchSize, start_cursor=cursor, keys_only=True
+            )
+            if keys:
+                ndb.delete_multi(keys)
+                deleted += len(keys)
+            if not more or not cursor:
+                break
+        return deleted
+
 
 class Product(TWNDBModel):
     name = web.StringProperty(required=True)
     googleFontsFamilySuffix = web.StringProperty()
     price = web.IntegerProperty(default=39)
-    font = web.FileProperty()
+    font = web.ChunkedFileProperty()
+
+    # Set on the products of the shared Catalog, see there
+    _readOnly = False
+
+    def __setattr__(self, name, value):
+        if self._readOnly and name in self._propertyRegistryByName:
+            raise AttributeError(f"Catalog products are read-only, fetch {self.key} to change “{name}”")
+        super(Product, self).__setattr__(name, value)
+
+    def beforePut(self):
+        if self._readOnly:
+            raise AttributeError(f"Catalog products are read-only, fetch {self.key} to put it")
 
+    def afterPut(self):
+        invalidateCatalog()
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        invalidateCatalog()
+
+    def fontUniqueID(self):
+        # Type.World uniqueID of the product’s (only) font
+        return "AwesomeFonts" + "-" + self.name.replace(" ", "") + "-" + "Regular"
+
+    @web.view
+    @web.cached
     def overview(self, parameters={}, directCallParameters={}):
         g.html.DIV(class_="clear product")
         g.html.DIV(class_="floatleft font", style=f"font-family: '{self.name}';")
@@ -89,7 +199,7 @@ class Product(TWNDBModel):
         g.html.DIV(class_="floatright buy")
         g.html.T(f"{self.price}€")
         g.html.BR()
-        g.html.A(onclick=f"buy('{self.name}');")
+        g.html.A(onclick=f"buy('{self.key.urlsafe().decode()}');")
         g.html.T("Buy")
         g.html._A()
         if g.admin:
@@ -101,24 +211,36 @@ class Product(TWNDBModel):
                 g.html.A(href=self.downloadLink("font"))
                 g.html.T("Download")
                 g.html._A()
+                if "stream" in self.font:
+                    g.html.BR()
+                    self.execute("Move font to blob store", methodName="migrateFont")
         g.html._DIV()
         g.html._DIV()  # .clear
 
+    @web.action
+    def migrateFont(self):
+        # Putting moves a legacy font (see web.ChunkedFileProperty)
+        self.putnow()
+
+    @web.view
+    @web.cached
     def cartview(self, parameters={}, directCallParameters={}):
         g.html.DIV(class_="clear cart")
         g.html.DIV(class_="floatleft font")
+        quantity = parameters.get("quantity", 1)
         g.html.T(self.name)
-        g.html.T(", 1 License")
+        g.html.T(f", {quantity} License{'s' if quantity != 1 else ''}")
         g.html._DIV()
         g.html.DIV(class_="floatright buy")
-        g.html.T(f"{self.price}€")
+        g.html.T(f"{self.price * quantity}€")
         g.html.T("&nbsp;&nbsp;")
-        g.html.A(onclick=f"remove('{self.name}');")
+        g.html.A(onclick=f"remove('{self.key.urlsafe().decode()}');")
         g.html.T("Remove")
         g.html._A()
         g.html._DIV()
         g.html._DIV()  # .clear
 
+    @web.view
     def accountview(self, parameters={}, directCallParameters={}):
         g.html.DIV(class_="clear account")
         g.html.DIV(class_="floatleft font")
@@ -126,3 +248,56 @@ class Product(TWNDBModel):
         g.html.T(", 1 License")
         g.html._DIV()
         g.html._DIV()  # .clear
+
+
+class CatalogGeneration(ndb.Model):
+    """
+    Bumped on every product change, so that all processes notice
+    that their catalog snapshot is outdated.
+    """
+
+    generation = ndb.IntegerProperty(indexed=False)
+
+
+class Catalog(object):
+    """
+    Snapshot of all products, looked up by key ID, name, or Type.World uniqueID.
+    The product instances are shared by all requests of the process, so they are marked read-only:
+    setting their properties or putting them raises AttributeError.
+    To change a product, fetch it by its key. Values like the `font` dictionary must not be changed in place either.
+    """
+
+    def __init__(self, products, generation):
+        self.generation = generation
+        self.products = tuple(products)
+        for product in self.products:
+            product._readOnly = True
+        self.byID = types.MappingProxyType({x.key.id(): x for x in self.products})
+        self.byName = types.MappingProxyType({x.name: x for x in self.products})
+        self.byUniqueID = types.MappingProxyType({x.fontUniqueID(): x for x in self.products})
+
+
+_catalog = None
+_catalogChecked = 0
+
+
+def catalog():
+    """
+    Return the current product catalog, re-querying the products only after they changed.
+    """
+    global _catalog, _catalogChecked
+
+    if _catalog is None or time.time() - _catalogChecked > definitions.CATALOG_CHECK_INTERVAL:
+        currentGeneration = ndb.Key(CatalogGeneration, "catalog").get(use_cache=False)
+        generation = currentGeneration.generation if currentGeneration else 0
+        if _catalog is None or _catalog.generation != generation:
+            _catalog = Catalog(Product.query().fetch(), generation)
+        _catalogChecked = time.time()
+
+    return _catalog
+
+
+def invalidateCatalog():
+    global _catalog
+    _catalog = None
+    CatalogGeneration(id="catalog", generation=time.time_ns()).put()
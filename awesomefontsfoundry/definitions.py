@@ -2,6 +2,45 @@ import awesomefontsfoundry
 
 TYPEWORLD_SIGNIN_SCOPE = "account,billingaddress,euvatid"
 
+# Seconds to cache type.world user data per token (classes.User.userdata())
+USERDATA_CACHE_TTL = 5 * 60
+# Seconds to remember that a token was revoked
+USERDATA_NEGATIVE_CACHE_TTL = 60
+# Maximum number of cached tokens per process
+USERDATA_CACHE_SIZE = 10000
+
+# Seconds between checks whether another process has changed the product catalog
+CATALOG_CHECK_INTERVAL = 10
+
+# How installFonts hands out fonts: "data" embeds them base64-encoded into the response,
+# "url" hands out signed links to /fontdownload that expire after FONT_URL_LIFETIME seconds
+FONT_DELIVERY = "data"
+FONT_URL_LIFETIME = 5 * 60
+
+# Seconds to remember successful/failed user verifications with the central type.world server
+VERIFYCREDENTIALS_CACHE_TTL = 10 * 60
+VERIFYCREDENTIALS_NEGATIVE_CACHE_TTL = 30
+
+# Addresses accepted by helpers.verifyEmail() without asking Mailgun (lowercase)
+KNOWNEMAILADDRESSES = ()
+# Seconds to remember email address verifications (helpers.verifyEmail(), emailverification.py)
+EMAIL_VERIFICATION_CACHE_TTL = 30 * 24 * 60 * 60
+EMAIL_VERIFICATION_NEGATIVE_CACHE_TTL = 24 * 60 * 60
+DISPOSABLE_DOMAIN_CACHE_TTL = 30 * 24 * 60 * 60
+
+# Seconds to remember VAT ID verifications (web.EUVATIDProperty, vatid.py)
+VATID_CACHE_TTL = 7 * 24 * 60 * 60
+VATID_INVALID_CACHE_TTL = 24 * 60 * 60
+# Seconds to wait for the verification service before accepting a VAT ID as pending verification
+VATID_LOOKUP_DEADLINE = 5
+# Seconds until a pending VAT ID gets checked again while the verification service has problems
+VATID_RECHECK_DELAY = 15 * 60
+
+# EU member states by VAT ID country code
+EU_COUNTRIES = "AT BE BG CY CZ DE DK EE EL ES FI FR HR HU IE IT LT LU LV MT NL PL PT RO SE SI SK".split()
+
+MAILGUNACCESSPOINT = "https://api.mailgun.net/v3/mail.type.world"
+
 if awesomefontsfoundry.GAE:
     TYPEWORLD_SIGNIN_URL = "https://type.world/signin"
     TYPEWORLD_GETTOKEN_URL = "https://type.world/auth/token"
@@ -0,0 +1,133 @@
+# project
+import awesomefontsfoundry
+from awesomefontsfoundry import definitions, helpers, outbound
+
+# other
+import concurrent.futures
+import datetime
+import hashlib
+import logging
+import requests
+from google.cloud import ndb
+
+# Email address verification through Mailgun
+#
+# Verdicts are stored as EmailVerification entities keyed by the hash of the normalized address,
+# for EMAIL_VERIFICATION_CACHE_TTL seconds (EMAIL_VERIFICATION_NEGATIVE_CACHE_TTL for rejected addresses).
+# Domains that Mailgun reports as disposable are remembered as DisposableDomain entities,
+# so further addresses of those domains get rejected without asking Mailgun.
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=outbound.MAX_CONNECTIONS_PER_HOST)
+
+
+class EmailVerification(ndb.Model):
+    # Key ID is addressHash()
+    valid = ndb.BooleanProperty(indexed=False)
+    checked = ndb.DateTimeProperty(indexed=False)
+
+    def current(self):
+        if self.valid:
+            ttl = definitions.EMAIL_VERIFICATION_CACHE_TTL
+        else:
+            ttl = definitions.EMAIL_VERIFICATION_NEGATIVE_CACHE_TTL
+        return self.checked + datetime.timedelta(seconds=ttl) > helpers.now()
+
+
+class DisposableDomain(ndb.Model):
+    # Key ID is the domain
+    checked = ndb.DateTimeProperty(indexed=False)
+
+    def current(self):
+        return self.checked + datetime.timedelta(seconds=definitions.DISPOSABLE_DOMAIN_CACHE_TTL) > helpers.now()
+
+
+def normalize(address):
+    return address.strip().lower()
+
+
+def addressHash(address):
+    return hashlib.sha256(normalize(address).encode()).hexdigest()
+
+
+def domain(address):
+    return normalize(address).split("@")[-1]
+
+
+def validate(address):
+    """
+    Ask Mailgun about an address. Returns (valid, disposable), or None if Mailgun can’t be reached
+    or doesn’t give a complete answer.
+    """
+    try:
+        response = outbound.get(
+            "https://api.mailgun.net/v4/address/validate",
+            auth=("api", awesomefontsfoundry.secret("MAILGUN_PRIVATEKEY")),
+            params={"address": address},
+        )
+        response.raise_for_status()
+        response = response.json()
+    except (requests.RequestException, ValueError) as e:
+        logging.warning(f"Email verification failed: {e}")
+        return None
+
+    # Error or partial payloads leave the address unverifiable
+    if not isinstance(response, dict):
+        response = {}
+    result = response.get("result")
+    disposable = response.get("is_disposable_address")
+    if result is None or not isinstance(disposable, bool):
+        logging.warning(f"Email verification returned an incomplete response: {response}")
+        return None
+
+    return result in ("deliverable", "unknown") and not disposable, disposable
+
+
+def verifyEmails(addresses):
+    """
+    Verify many addresses at once, e.g. for imports.
+    Returns a dictionary of address → True/False.
+    Cached verdicts are looked up in one batch, the remaining addresses are sent to Mailgun concurrently.
+    """
+
+    results = {}
+    addresses = list(set(addresses))
+
+    for address in addresses:
+        if normalize(address) in definitions.KNOWNEMAILADDRESSES:
+            results[address] = True
+    addresses = [x for x in addresses if x not in results]
+
+    verifications = ndb.get_multi([ndb.Key(EmailVerification, addressHash(x)) for x in addresses])
+    domains = sorted(set([domain(x) for x in addresses]))
+    disposableDomains = dict(zip(domains, ndb.get_multi([ndb.Key(DisposableDomain, x) for x in domains])))
+
+    unknown = []
+    for address, verification in zip(addresses, verifications):
+        disposableDomain = disposableDomains[domain(address)]
+        if disposableDomain and disposableDomain.current():
+            results[address] = False
+        elif verification and verification.current():
+            results[address] = verification.valid
+        else:
+            unknown.append(address)
+
+    now = helpers.now()
+    entities = []
+    for address, verdict in zip(unknown, _executor.map(validate, unknown)):
+        # Accept addresses that can’t be verified right now, like Mailgun’s "unknown" result, without caching that
+        if verdict is None:
+            results[address] = True
+            continue
+        valid, disposable = verdict
+        results[address] = valid
+        entities.append(EmailVerification(id=addressHash(address), valid=valid, checked=now))
+        if disposable:
+            entities.append(DisposableDomain(id=domain(address), checked=now))
+    if entities:
+        ndb.put_multi(entities)
+
+    return results
+
+
+def verifyEmail(address):
+    return verifyEmails([address])[address]
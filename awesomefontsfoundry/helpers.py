@@ -1,33 +1,28 @@
-# project
-import awesomefontsfoundry
-
-# from awesomefontsfoundry import definitions
-
 # other
 import sys
 import os
 import datetime
 import typeworld.client
-import requests
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "lib"))
 
 
 def verifyEmail(email):
+    """
+    Verify an email address through Mailgun, with cached verdicts (see emailverification.py).
+    """
+    from awesomefontsfoundry import emailverification
 
-    if email in definitions.KNOWNEMAILADDRESSES:
-        return True
+    return emailverification.verifyEmail(email)
 
-    response = requests.get(
-        "https://api.mailgun.net/v4/address/validate",
-        auth=("api", awesomefontsfoundry.secret("MAILGUN_PRIVATEKEY")),
-        params={"address": email},
-    ).json()
 
-    if response["result"] in ("deliverable", "unknown") and response["is_disposable_address"] is False:
-        return True
-    else:
-        return False
+def verifyEmails(emails):
+    """
+    Verify many email addresses at once. Returns a dictionary of address → True/False.
+    """
+    from awesomefontsfoundry import emailverification
+
+    return emailverification.verifyEmails(emails)
 
 
 def now():
@@ -63,7 +58,12 @@ def unsecretURL(url):
         return customProtocol + protocol + "+" + transportProtocol.replace("://", "//") + domain
 
 
-def email(from_, to, subject, body, replyTo=None):
+def email(from_, to, subject, body, replyTo=None, idempotencyKey=None):
+    """
+    Queue an email for delivery in the background (see outbox.py).
+    Emails with the same `idempotencyKey` only get sent once.
+    """
+    from awesomefontsfoundry import outbox
 
     assert type(from_) == str
     assert type(to) in (list, tuple)
@@ -72,22 +72,7 @@ def email(from_, to, subject, body, replyTo=None):
     if replyTo:
         assert type(replyTo) == str
 
-    url = "%s/messages" % definitions.MAILGUNACCESSPOINT
-    parameters = {
-        "from": from_,
-        "to": to,
-        "subject": subject,
-        "text": body,
-    }
-    if replyTo:
-        parameters["h:Reply-To"] = replyTo
-
-    auth = ("api", awesomefontsfoundry.secret("MAILGUN_PRIVATEKEY"))
-    response = requests.post(url, data=parameters, auth=requests.auth.HTTPBasicAuth(*auth))
-    if response.status_code != 200:
-        return False, f"HTTP Error {response.status_code}"
-
-    # logging.warning(f"Sent email ({subject}) to {to}, request status: {response.status_code}")
+    outbox.enqueue(from_, to, subject, body, replyTo, idempotencyKey)
 
     return True, None
 
@@ -2,13 +2,10 @@
 import awesomefontsfoundry
 from awesomefontsfoundry import definitions
 
-
 # other
 import hotmetal
 from flask import request, g
 
-awesomefontsfoundry.app.config["modules"].append("hypertext")
-
 ###
 
 
@@ -245,7 +242,7 @@ class HTML(hotmetal.HotMetal):
                     onclick=(
                         f"login('{definitions.TYPEWORLD_SIGNIN_URL}',"
                         f" '{awesomefontsfoundry.secret('TYPEWORLD_SIGNIN_CLIENTID')}', window.location.href,"
-                        f" '{definitions.TYPEWORLD_SIGNIN_SCOPE}', '{g.session.get('loginCode')}')"
+                        f" '{definitions.TYPEWORLD_SIGNIN_SCOPE}', '{awesomefontsfoundry.loginCode()}')"
                     )
                 )
                 self.T('<span class="material-icons-outlined">login</span> Sign In with Type.World')
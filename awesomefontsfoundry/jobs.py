@@ -0,0 +1,220 @@
+# project
+import awesomefontsfoundry
+from awesomefontsfoundry import helpers
+
+# other
+import datetime
+from flask import g, has_request_context
+import logging
+import os
+import random
+import threading
+import traceback
+from google.cloud import ndb
+
+# Durable background jobs
+#
+# Jobs are stored as Job entities at enqueue time, so they survive the request and
+# the process that created them. An in-process worker thread (started with the first
+# enqueued job, locally as well as on App Engine) picks up due jobs, runs them
+# and retries failed ones with exponential backoff until MAX_ATTEMPTS is reached.
+#
+# Job functions are registered by name with the @task decorator and get called
+# with the job’s parameters as keyword arguments. They must be safe to run more than once.
+# Raising Retry reschedules a job without using up an attempt (e.g. when rate limited),
+# raising PermanentError fails it right away. Failed jobs are kept as dead letters.
+# The parameters of done jobs are cleared, as they may contain secrets. Done and failed jobs
+# get deleted RETENTION seconds after they finished by the /cron/sweepjobs cron job.
+#
+# The ID of a job is its idempotency key: enqueueing a job whose ID already exists
+# doesn’t create a second one.
+#
+# Jobs enqueued during a request wake up the worker only after the request’s unit of work
+# has been written (see web.flushPuts()), so that they see the request’s changes.
+#
+# Querying due and finished jobs requires the composite indexes in index.yaml.
+
+MAX_ATTEMPTS = 8
+RETRY_DELAY = 10  # seconds, doubled with every attempt
+LEASE = 5 * 60  # seconds a worker may run a job before others consider it abandoned
+POLL_INTERVAL = 30  # seconds between checks for due jobs
+RETENTION = 14 * 24 * 60 * 60  # seconds finished jobs are kept
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+TASKS = {}
+
+
+class Retry(Exception):
+    def __init__(self, delay, message=""):
+        super().__init__(message)
+        self.delay = delay
+
+
+class PermanentError(Exception):
+    pass
+
+
+def task(function):
+    """
+    Register a function to be run as a job
+    """
+    TASKS[function.__name__] = function
+    return function
+
+
+class Job(ndb.Model):
+    task = ndb.StringProperty()
+    parameters = ndb.JsonProperty()
+    status = ndb.StringProperty(default=PENDING)
+    attempts = ndb.IntegerProperty(default=0)
+    due = ndb.DateTimeProperty()
+    lastError = ndb.TextProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    touched = ndb.DateTimeProperty(auto_now=True)
+
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    @classmethod
+    def sweep(cls, before, batchSize=500):
+        """
+        Delete all done and failed jobs last touched before `before`, in batches of `batchSize`.
+        Returns the number of deleted jobs.
+        """
+        deleted = 0
+        for status in (DONE, FAILED):
+            cursor = None
+            while True:
+                keys, cursor, more = cls.query(cls.status == status, cls.touched < before).fetch_page(
+                    batchSize, start_cursor=cursor, keys_only=True
+                )
+                if keys:
+                    ndb.delete_multi(keys)
+                    deleted += len(keys)
+                if not more or not cursor:
+                    break
+        return deleted
+
+
+def enqueue(taskName, idempotencyKey, **parameters):
+    """
+    Store a job and wake up the worker. Returns the job.
+    """
+    assert taskName in TASKS
+
+    @ndb.transactional()
+    def insert():
+        job = Job.get_by_id(idempotencyKey)
+        if job is None:
+            job = Job(id=idempotencyKey, task=taskName, parameters=parameters, due=helpers.now())
+            job.put()
+        return job
+
+    job = insert()
+    startWorker()
+    if has_request_context() and g.get("ndb_puts") is not None:
+        g.wakeUpJobWorker = True
+    else:
+        _wakeUp.set()
+    return job
+
+
+def afterRequest():
+    """
+    Wake up the worker for jobs enqueued during the request, once its entities have been written
+    """
+    if has_request_context() and g.get("wakeUpJobWorker"):
+        g.wakeUpJobWorker = False
+        _wakeUp.set()
+
+
+def claim(key):
+    """
+    Mark a due job as running, unless another worker got to it first.
+    Returns the job or None.
+    """
+
+    @ndb.transactional()
+    def transaction():
+        job = key.get()
+        if job is None or job.finished() or job.due > helpers.now():
+            return None
+        job.status = RUNNING
+        job.attempts += 1
+        job.due = helpers.now() + datetime.timedelta(seconds=LEASE)
+        job.put()
+        return job
+
+    return transaction()
+
+
+def run(key):
+    """
+    Run a job if it is due. Returns the job’s latest state.
+    """
+    job = claim(key)
+    if job is None:
+        return key.get()
+
+    try:
+        TASKS[job.task](**job.parameters)
+        job.status = DONE
+        job.parameters = None
+        job.lastError = None
+    except Retry as e:
+        job.status = PENDING
+        job.attempts -= 1
+        job.lastError = str(e)
+        job.due = helpers.now() + datetime.timedelta(seconds=e.delay)
+    except Exception as e:
+        job.lastError = traceback.format_exc()
+        logging.warning(f"Job {key.id()} ({job.task}) failed in attempt {job.attempts}:\n{job.lastError}")
+        if job.attempts >= MAX_ATTEMPTS or isinstance(e, PermanentError):
+            job.status = FAILED
+            logging.error(f"Job {key.id()} ({job.task}) failed permanently")
+        else:
+            job.status = PENDING
+            delay = RETRY_DELAY * (2 ** (job.attempts - 1)) * random.uniform(0.75, 1.25)
+            job.due = helpers.now() + datetime.timedelta(seconds=delay)
+    job.put()
+    return job
+
+
+def runDue(limit=20):
+    """
+    Run all jobs that are due now, including abandoned running jobs whose lease has expired
+    """
+    for status in (PENDING, RUNNING):
+        for key in Job.query(Job.status == status, Job.due <= helpers.now()).fetch(limit, keys_only=True):
+            run(key)
+
+
+_wakeUp = threading.Event()
+_workerPID = None
+_workerLock = threading.Lock()
+
+
+def worker():
+    while True:
+        _wakeUp.wait(POLL_INTERVAL)
+        _wakeUp.clear()
+        try:
+            with awesomefontsfoundry.client.context():
+                runDue()
+        except Exception:
+            logging.exception("Job worker")
+
+
+def startWorker():
+    """
+    Start the worker thread once per process (gunicorn forks workers after import)
+    """
+    global _workerPID
+    with _workerLock:
+        if _workerPID != os.getpid():
+            _workerPID = os.getpid()
+            threading.Thread(target=worker, daemon=True).start()
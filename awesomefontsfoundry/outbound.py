@@ -0,0 +1,80 @@
+# other
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+from requests.adapters import HTTPAdapter
+
+# Shared client for all outbound HTTP calls.
+# Connections are kept alive in per-host pools, every call has connect/read timeouts,
+# failed calls are retried with exponential backoff and jitter, and the number of
+# concurrent calls per host is limited.
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 20
+RETRIES = 2
+BACKOFF = 0.25
+MAX_CONNECTIONS_PER_HOST = 10
+RETRY_STATUS_CODES = (502, 503, 504)
+
+_session = requests.Session()
+_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+_session.mount("https://", _adapter)
+_session.mount("http://", _adapter)
+
+_hostSemaphores = {}
+_hostSemaphoresLock = threading.Lock()
+
+
+def hostSemaphore(host):
+    with _hostSemaphoresLock:
+        if host not in _hostSemaphores:
+            _hostSemaphores[host] = threading.BoundedSemaphore(MAX_CONNECTIONS_PER_HOST)
+        return _hostSemaphores[host]
+
+
+def request(method, url, idempotent=None, retries=RETRIES, timeout=None, **kwargs):
+    """
+    Perform an HTTP request through the shared session and return the `requests` response.
+    Idempotent requests (GET by default, or when `idempotent` is set) get retried on connection errors,
+    timeouts and 502/503/504 responses. Other requests only get retried when the connection couldn’t be made,
+    as the server can’t have received them.
+    Raises requests.RequestException once all attempts have failed.
+    """
+
+    if idempotent is None:
+        idempotent = method.upper() in ("GET", "HEAD", "OPTIONS")
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+
+    semaphore = hostSemaphore(urlparse(url).netloc)
+
+    for attempt in range(retries + 1):
+        try:
+            with semaphore:
+                response = _session.request(method, url, timeout=timeout, **kwargs)
+            if not (idempotent and response.status_code in RETRY_STATUS_CODES and attempt < retries):
+                return response
+            logging.warning(f"{method} {url} returned HTTP {response.status_code}, retrying")
+
+        except requests.exceptions.ConnectTimeout:
+            if attempt == retries:
+                raise
+            logging.warning(f"{method} {url} couldn’t connect, retrying")
+
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if not idempotent or attempt == retries:
+                raise
+            logging.warning(f"{method} {url} failed, retrying")
+
+        time.sleep(BACKOFF * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -0,0 +1,159 @@
+# project
+import awesomefontsfoundry
+from awesomefontsfoundry import definitions, helpers, jobs, outbound
+
+# other
+import datetime
+import email.message
+import hashlib
+import os
+import smtplib
+import requests
+from google.cloud import ndb
+
+# Outgoing emails
+#
+# helpers.email() only stores a message as a "sendEmail" job, the job worker delivers it
+# in the background along with other due jobs. Deliveries are retried with exponential backoff,
+# messages that can’t be delivered stay in the Datastore as failed jobs.
+# Messages can contain secrets like password reset links: the job of a delivered message keeps
+# neither addresses nor content, and failed jobs get deleted after jobs.RETENTION seconds.
+#
+# Every recipient receives at most RATE_LIMIT emails per RATE_WINDOW seconds,
+# further emails get postponed until the window has passed. Failed deliveries don’t count.
+#
+# Emails are delivered through Mailgun by default. For running locally and for tests,
+# set app.config["EMAIL_BACKEND"] (or the AWESOMEFONTS_EMAIL_BACKEND environment variable) to "smtp"
+# to deliver them to the SMTP server in app.config["EMAIL_SMTP_SERVER"] instead,
+# for example `python -m aiosmtpd -n -l localhost:1025`,
+# or point app.config["MAILGUN_ACCESSPOINT"] to a local HTTP server.
+
+RATE_LIMIT = 5
+RATE_WINDOW = 60 * 60
+
+awesomefontsfoundry.app.config["EMAIL_BACKEND"] = os.getenv("AWESOMEFONTS_EMAIL_BACKEND", "mailgun")
+awesomefontsfoundry.app.config["EMAIL_SMTP_SERVER"] = os.getenv("AWESOMEFONTS_SMTP_SERVER", "localhost:1025")
+awesomefontsfoundry.app.config["MAILGUN_ACCESSPOINT"] = os.getenv(
+    "AWESOMEFONTS_MAILGUN_ACCESSPOINT", definitions.MAILGUNACCESSPOINT
+)
+
+
+class EmailRecipient(ndb.Model):
+    # Key ID is the hash of the normalized address
+    windowStart = ndb.DateTimeProperty(indexed=False)
+    count = ndb.IntegerProperty(indexed=False, default=0)
+
+
+def recipientKey(address):
+    # "Name <name@example.com>" → "name@example.com"
+    if "<" in address:
+        address = address.split("<")[-1].split(">")[0]
+    return ndb.Key(EmailRecipient, hashlib.sha256(address.strip().lower().encode()).hexdigest())
+
+
+def reserve(recipients):
+    """
+    Count an email towards the rate limit of all its recipients.
+    Returns 0 if it may be sent now, otherwise the seconds to wait without counting it.
+    """
+
+    @ndb.transactional()
+    def transaction():
+        keys = list(set([recipientKey(x) for x in recipients]))
+        entities = ndb.get_multi(keys)
+        now = helpers.now()
+        window = datetime.timedelta(seconds=RATE_WINDOW)
+
+        for i, entity in enumerate(entities):
+            if entity is None or entity.windowStart + window <= now:
+                entities[i] = entity = EmailRecipient(key=keys[i], windowStart=now, count=0)
+            if entity.count >= RATE_LIMIT:
+                return (entity.windowStart + window - now).total_seconds()
+
+        for entity in entities:
+            entity.count += 1
+        ndb.put_multi(entities)
+        return 0
+
+    return transaction()
+
+
+def release(recipients):
+    """
+    Give back the slot that reserve() counted for an email that couldn’t be delivered.
+    """
+
+    @ndb.transactional()
+    def transaction():
+        keys = list(set([recipientKey(x) for x in recipients]))
+        entities = [x for x in ndb.get_multi(keys) if x is not None and x.count > 0]
+        for entity in entities:
+            entity.count -= 1
+        ndb.put_multi(entities)
+
+    transaction()
+
+
+def enqueue(from_, to, subject, body, replyTo=None, idempotencyKey=None):
+    message = {
+        "from_": from_,
+        "to": list(to),
+        "subject": subject,
+        "body": body,
+        "replyTo": replyTo,
+    }
+    return jobs.enqueue("sendEmail", idempotencyKey or f"email-{helpers.Garbage(40)}", **message)
+
+
+@jobs.task
+def sendEmail(from_, to, subject, body, replyTo=None):
+    wait = reserve(to)
+    if wait:
+        raise jobs.Retry(wait, "Rate limit reached for recipients")
+
+    # Only delivered emails count towards the rate limit
+    try:
+        if awesomefontsfoundry.app.config["EMAIL_BACKEND"] == "smtp":
+            deliverViaSMTP(from_, to, subject, body, replyTo)
+        else:
+            deliverViaMailgun(from_, to, subject, body, replyTo)
+    except Exception:
+        release(to)
+        raise
+
+
+def deliverViaMailgun(from_, to, subject, body, replyTo=None):
+    url = "%s/messages" % awesomefontsfoundry.app.config["MAILGUN_ACCESSPOINT"]
+    parameters = {
+        "from": from_,
+        "to": to,
+        "subject": subject,
+        "text": body,
+    }
+    if replyTo:
+        parameters["h:Reply-To"] = replyTo
+
+    auth = ("api", awesomefontsfoundry.secret("MAILGUN_PRIVATEKEY"))
+    response = outbound.post(url, data=parameters, auth=requests.auth.HTTPBasicAuth(*auth))
+
+    if response.status_code == 429:
+        raise jobs.Retry(60, "Mailgun rate limit")
+    # Rejected messages won’t be accepted on a later attempt either
+    if 400 <= response.status_code < 500:
+        raise jobs.PermanentError(f"HTTP Error {response.status_code}: {response.text}")
+    if response.status_code != 200:
+        raise Exception(f"HTTP Error {response.status_code}")
+
+
+def deliverViaSMTP(from_, to, subject, body, replyTo=None):
+    message = email.message.EmailMessage()
+    message["From"] = from_
+    message["To"] = ", ".join(to)
+    message["Subject"] = subject
+    if replyTo:
+        message["Reply-To"] = replyTo
+    message.set_content(body)
+
+    host, port = awesomefontsfoundry.app.config["EMAIL_SMTP_SERVER"].split(":")
+    with smtplib.SMTP(host, int(port), timeout=outbound.READ_TIMEOUT) as server:
+        server.send_message(message)
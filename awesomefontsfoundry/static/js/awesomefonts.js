@@ -10,12 +10,12 @@ function logout() {
     AJAX('#action', '/logout');
 }
 
-function buy(name) {
-    AJAX('#action', '/cart/add', { "products": name });
+function buy(key) {
+    AJAX('#action', '/cart/add', { "products": key });
 }
 
-function remove(name) {
-    AJAX('#action', '/cart/remove', { "products": name });
+function remove(key) {
+    AJAX('#action', '/cart/remove', { "products": key });
 }
 
 function checkout() {
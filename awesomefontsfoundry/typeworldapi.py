@@ -1,10 +1,15 @@
 import awesomefontsfoundry
-from awesomefontsfoundry import classes, definitions
+from awesomefontsfoundry import blobs, classes, definitions, outbound
 from flask import request, Response, abort
+import requests
 import typeworld
 import typeworld.api
 import json
 import base64
+import hashlib
+import hmac
+import time
+import uuid
 
 from awesomefontsfoundry import helpers
 
@@ -28,6 +33,9 @@ def api():
     appVersion = request.values.get("appVersion")
     verifiedTypeWorldUserCredentials = None
 
+    # Font data to be streamed into the response, see streamJSON()
+    payloads = {}
+
     # API Root
     root = typeworld.api.RootResponse()
     subscriptionURL = f"typeworld://json+https//{subscriptionID}:{secretKey}@awesomefonts.appspot.com/typeworldapi"
@@ -84,6 +92,7 @@ def api():
                 verifiedTypeWorldUserCredentials,
                 userName,
                 userEmail,
+                payloads,
             )
 
             # Process: Return value is of type integer, which means we handle a request abort with HTTP code
@@ -122,10 +131,31 @@ def api():
     # In the future, the validator will also be made available offline in `typeworld.tools`
     jsonData = root.dumpJSON()
 
+    # Font data gets streamed in place of its placeholders
+    if payloads:
+        return Response(streamJSON(jsonData, payloads), mimetype="application/json")
+
     # Return the response with the correct MIME type `application/json` (or otherwise the app will complain)
     return Response(jsonData, mimetype="application/json")
 
 
+def streamJSON(jsonData, payloads):
+    """
+    Yield `jsonData` with each placeholder in `payloads` replaced by the base64-encoded
+    content of its file, read from the base64 cache or the blob store chunk by chunk.
+    """
+
+    # Runs after the request has returned, so it needs its own Datastore context
+    with awesomefontsfoundry.client.context():
+        position = 0
+        for placeholder, file in payloads.items():
+            index = jsonData.index(placeholder, position)
+            yield jsonData[position:index].encode()
+            yield from blobs.base64Cache().iterate(file)
+            position = index + len(placeholder)
+        yield jsonData[position:].encode()
+
+
 def endpoint(root):
     """
     Process `endpoint` command
@@ -302,6 +332,7 @@ def installFonts(
     verifiedTypeWorldUserCredentials,
     userName,
     userEmail,
+    payloads=None,
 ):
     """
     Process `installFonts` command
@@ -380,6 +411,7 @@ def installFonts(
         userName,
         userEmail,
         __ownDataSource__,
+        payloads,
     )
 
     # Process: Return value is of type integer, which means we handle a request abort with HTTP code
@@ -460,7 +492,7 @@ def uninstallFonts(
 
     # Still didn’t pass security check, return `insufficientPermission` immediately
     if securityCheckPassed == False:
-        installableFonts.response = "insufficientPermission"
+        uninstallFonts.response = "insufficientPermission"
         return True, None
 
     # End of SECURITY CHECK
@@ -474,7 +506,7 @@ def uninstallFonts(
 
     # Create object tree for `uninstallFonts` out of font data in `__ownDataSource__`
     success, message = createUninstallFontsObjectTree(
-        installFonts, fonts, subscriptionID, anonymousAppID, __ownDataSource__
+        uninstallFonts, fonts, subscriptionID, anonymousAppID, None, None, __ownDataSource__
     )
 
     # Process: Return value is of type integer, which means we handle a request abort with HTTP code
@@ -553,7 +585,7 @@ def createInstallableFontsObjectTree(installableFonts, __user__):
     licenseDefition.URL = "https://scripts.sil.org/OFL"
 
     # Families
-    for product in [x.get() for x in __user__.purchasedProductKeys]:
+    for product in classes.Product.getMulti(__user__.purchasedProductKeys):
 
         # Create Family object, attach to `foundry`
         family = typeworld.api.Family()
@@ -574,7 +606,7 @@ def createInstallableFontsObjectTree(installableFonts, __user__):
         font.name.en = "Regular"
         font.postScriptName = product.name.replace(" ", "") + "-" + "Regular"
         font.purpose = "desktop"
-        font.format = product.font["filename"].split(".")[-1]
+        font.format = product.font["format"]
         font.status = "stable"
 
         # Version
@@ -591,10 +623,12 @@ def createInstallableFontsObjectTree(installableFonts, __user__):
     return True, None
 
 
-def productByID(fontID):
-    for product in classes.Product.query().fetch():
-        if product.name.replace(" ", "") in fontID:
-            return product
+def productsByID(fontIDs):
+    """
+    Resolve a list of Type.World font IDs to products (or None for unknown fonts) in one go
+    """
+    byUniqueID = classes.catalog().byUniqueID
+    return [byUniqueID.get(fontID) for fontID in fontIDs]
 
 
 def createInstallFontsObjectTree(
@@ -605,9 +639,12 @@ def createInstallFontsObjectTree(
     userName,
     userEmail,
     __ownDataSource__,
+    payloads=None,
 ):
     """
     Apply incoming data of `__ownDataSource__` to `installFonts`
+    If a `payloads` dictionary is given, font data isn’t encoded here but replaced by a placeholder
+    and collected in `payloads` to be streamed into the response later (see streamJSON()).
     """
 
     # Parse fonts into list
@@ -615,19 +652,21 @@ def createInstallFontsObjectTree(
     # "font1ID/font1Version,font2ID/font2Version" becomes [['font1ID', 'font1Version'], ['font2ID', 'font2Version']]
     fontsList = [x.split("/") for x in fonts.split(",")]
 
-    # Loop over incoming fonts list
-    for fontID, fontVersion in fontsList:
+    # Load own data source
+    products = productsByID([fontID for fontID, fontVersion in fontsList])
 
-        # Load own data source
-        product = productByID(fontID)
+    # Loop over incoming fonts list
+    for (fontID, fontVersion), product in zip(fontsList, products):
 
         # Create InstallFontAsset object, attach to `installFonts.assets`
         asset = typeworld.api.InstallFontAsset()
         installFonts.assets.append(asset)
 
         # Couldn't find data source by ID, return `unknownFont`
-        if product == None:
+        if product is None:
+            asset.uniqueID = fontID
             asset.response = "unknownFont"
+            continue
 
         # In case your server observes license compliance, it needs to track
         # font installations. These are identified by the tripled
@@ -644,10 +683,19 @@ def createInstallFontsObjectTree(
 
         # Apply data
         asset.response = "success"
-        asset.uniqueID = "AwesomeFonts" + "-" + product.name.replace(" ", "") + "-" + "Regular"
-        asset.encoding = "base64"
-        asset.mimeType = "font/" + product.font["filename"].split(".")[-1]
-        asset.data = base64.b64encode(product.font["stream"]).decode()
+        asset.uniqueID = product.fontUniqueID()
+        asset.mimeType = "font/" + product.font["format"]
+        if definitions.FONT_DELIVERY == "url" and "hash" in product.font:
+            asset.dataURL = fontDownloadURL(product.font)
+        elif payloads is not None:
+            asset.encoding = "base64"
+            # Valid base64 itself, so the object tree still validates
+            placeholder = base64.b64encode(f"awesomefonts-placeholder-{uuid.uuid4()}".encode()).decode()
+            payloads[placeholder] = product.font
+            asset.data = placeholder
+        else:
+            asset.encoding = "base64"
+            asset.data = b"".join(blobs.base64Cache().iterate(product.font)).decode()
         asset.version = 1.0
 
         # # Font is not a free font
@@ -697,6 +745,52 @@ def createInstallFontsObjectTree(
     return True, None
 
 
+def fontDownloadSignature(digest, format, expires):
+    return hmac.new(
+        awesomefontsfoundry.app.secret_key.encode(), f"{digest}:{format}:{expires}".encode(), hashlib.sha256
+    ).hexdigest()
+
+
+def fontDownloadURL(file):
+    """
+    Signed link to a font file’s raw content, valid for definitions.FONT_URL_LIFETIME seconds
+    """
+    expires = int(time.time()) + definitions.FONT_URL_LIFETIME
+    signature = fontDownloadSignature(file["hash"], file["format"], expires)
+    return (
+        f"{definitions.ROOT}/fontdownload/{file['hash']}"
+        f"?format={file['format']}&expires={expires}&signature={signature}"
+    )
+
+
+@awesomefontsfoundry.app.route("/fontdownload/<digest>", methods=["GET"])
+def fontdownload(digest):
+
+    format = request.values.get("format") or ""
+    expires = request.values.get("expires") or ""
+    signature = request.values.get("signature") or ""
+
+    if not expires.isdigit() or int(expires) < time.time():
+        return abort(403)
+    if not hmac.compare_digest(signature, fontDownloadSignature(digest, format, expires)):
+        return abort(403)
+
+    size = blobs.store().size(digest)
+    if size is None:
+        return abort(404)
+
+    def stream():
+        # Runs after the request has returned, so it needs its own Datastore context
+        with awesomefontsfoundry.client.context():
+            yield from blobs.store().iterate(digest)
+
+    return Response(
+        stream(),
+        mimetype=f"font/{format}",
+        headers={"Content-Length": str(size), "Cache-Control": "private, max-age=0"},
+    )
+
+
 def createUninstallFontsObjectTree(
     uninstallFonts,
     fonts,
@@ -715,19 +809,21 @@ def createUninstallFontsObjectTree(
     # "font1ID,font2ID" becomes ['font1ID', 'font2ID']
     fontsList = fonts.split(",")
 
-    # Loop over incoming fonts list
-    for fontID in fontsList:
+    # Load own data source
+    products = productsByID(fontsList)
 
-        # Load own data source
-        product = productByID(fontID)
+    # Loop over incoming fonts list
+    for fontID, product in zip(fontsList, products):
 
         # Create UninstallFontAsset object, attach to `uninstallFonts.assets`
         asset = typeworld.api.UninstallFontAsset()
         uninstallFonts.assets.append(asset)
+        asset.uniqueID = fontID
 
         # Couldn't find data source by ID, set response, return immediately
-        if product == None:
+        if product is None:
             asset.response = "unknownFont"
+            continue
 
         # # See how many seats the user has installed
         # seats = __ownDataSource__.__recordedFontInstallations__(fontID, subscriptionID, anonymousAppID)
@@ -762,6 +858,35 @@ def createUninstallFontsObjectTree(
     return True, None
 
 
+# Results of verifyUserCredentials(), keyed by hash of (anonymousAppID, anonymousTypeWorldUserID, subscriptionURL)
+_verifiedCredentials = {}
+
+
+def verifiedCredentialsKey(anonymousAppID, anonymousTypeWorldUserID, subscriptionURL):
+    return hashlib.sha256(f"{anonymousAppID}|{anonymousTypeWorldUserID}|{subscriptionURL}".encode()).hexdigest()
+
+
+def rememberVerifiedCredentials(cacheKey, verified, ttl):
+    # Drop expired entries once in a while
+    if len(_verifiedCredentials) > 10000:
+        now = time.time()
+        for key in [x for x in _verifiedCredentials if _verifiedCredentials[x][1] <= now]:
+            del _verifiedCredentials[key]
+    _verifiedCredentials[cacheKey] = (verified, time.time() + ttl)
+
+
+def purgeVerifiedCredentials(anonymousAppID=None, anonymousTypeWorldUserID=None, subscriptionURL=None):
+    """
+    Forget remembered verifications, either for one app/user/subscription combination or all of them
+    """
+    if anonymousAppID is None and anonymousTypeWorldUserID is None and subscriptionURL is None:
+        _verifiedCredentials.clear()
+    else:
+        _verifiedCredentials.pop(
+            verifiedCredentialsKey(anonymousAppID, anonymousTypeWorldUserID, subscriptionURL), None
+        )
+
+
 def verifyUserCredentials(
     APIKey,
     incomingAPIKey,
@@ -783,6 +908,14 @@ def verifyUserCredentials(
     if APIKey == incomingAPIKey:
         return True
 
+    # The same app/user combination has been verified recently
+    cacheKey = verifiedCredentialsKey(anonymousAppID, anonymousTypeWorldUserID, subscriptionURL)
+    if cacheKey in _verifiedCredentials:
+        verified, expires = _verifiedCredentials[cacheKey]
+        if expires > time.time():
+            return verified
+        del _verifiedCredentials[cacheKey]
+
     # Otherwise, send the normal verification request to the central server
 
     # Default parameters
@@ -798,29 +931,37 @@ def verifyUserCredentials(
     if subscriptionURL:
         parameters["subscriptionURL"] = subscriptionURL
 
-    # We’re using typeworld’s built-in request() method here which loops through a request up to 10 times
-    # in case an instance of the central server disappears during the request.
+    # The request is retried (see outbound.request()) in case an instance of the central server
+    # disappears during the request.
     # See the WARNING at https://type.world/developer#typeworld-api
     # If you’re implementing this in a language other than Python, make sure to read and follow that warning.
-    success, response, responseObject = typeworld.client.request(
-        "https://api.type.world/v1/verifyCredentials", parameters
-    )
+    try:
+        responseObject = outbound.post(
+            "https://api.type.world/v1/verifyCredentials", data=parameters, idempotent=True, retries=5
+        )
+        success = responseObject.status_code == 200
+    except requests.RequestException:
+        success = False
 
     # Request was successfully returned
     # Note: This means that the HTTP request was successful, not that the user has been verified. This will be confirmed a few lines down.
     if success:
 
         # Read response data from a JSON string
-        responseData = json.loads(response.decode())
+        responseData = json.loads(responseObject.content.decode())
 
         print("verifyUserCredentials response", responseData)
 
         # Verfification process was successful
         if responseData["response"] == "success":
 
-            # Return True immediately
+            # Remember and return True immediately
+            rememberVerifiedCredentials(cacheKey, True, definitions.VERIFYCREDENTIALS_CACHE_TTL)
             return True
 
+        # Verification was denied, remember that briefly
+        rememberVerifiedCredentials(cacheKey, False, definitions.VERIFYCREDENTIALS_NEGATIVE_CACHE_TTL)
+
     # No previous success, so let’s return False
     return False
 
@@ -0,0 +1,231 @@
+# project
+from awesomefontsfoundry import definitions, helpers, jobs, outbound
+
+# other
+import concurrent.futures
+import datetime
+import xml.etree.ElementTree as ET
+import requests
+from google.cloud import ndb
+
+# Verification of EU VAT IDs with the German Federal Central Tax Office (evatr.bff-online.de)
+#
+# Results are stored as VATIDVerification entities and reused for VATID_CACHE_TTL seconds
+# (VATID_INVALID_CACHE_TTL for invalid IDs). The remote call gets VATID_LOOKUP_DEADLINE seconds.
+# If it doesn’t answer in time or reports a temporary problem, the VAT ID is accepted
+# as pending verification and checked again in the background by a "recheckVATID" job.
+# If the recheck finds the VAT ID invalid, the administrator is informed by email.
+
+OWN_VATID = "DE212651941"
+URL = "https://evatr.bff-online.de/evatrRPC?UstId_1=%s&UstId_2=%s"
+
+# https://evatr.bff-online.de/eVatR/xmlrpc/codes
+VALID_CODES = ("200", "216", "218", "219", "222")
+TEMPORARY_CODES = ("205", "208", "217", "220", "999")
+EMAIL_FOR_CODES = ("200", "205", "206", "207", "214", "215", "217", "220", "999")
+# Codes about our own request rather than the VAT ID, not worth remembering
+UNCACHED_CODES = ("206", "207", "213", "214", "215", "221")
+
+RESPONSES = {
+    "200": "Die angefragte USt-IdNr. ist gültig.",
+    "201": "The VAT ID is invalid.",
+    "202": (
+        "The VAT ID is invalid. It is not registered in the business database"
+        " of the respective EU member country. You may have to apply with your"
+        " finance authorities to have your number registered in the respective"
+        " database."
+    ),
+    "203": "The VAT ID is valid only starting %(Gueltig_ab)s.",
+    "204": "The VAT ID was valid only between %(Gueltig_ab)s and %(Gueltig_bis)s.",
+    "205": "The request can’t be processed at the moment. Please try again later.",
+    "206": "The German VAT ID of the seller is invalid.",
+    "207": "The German VAT ID is not authorized to request VAT ID verifications.",
+    "208": "Another request is currently running for this VAT ID. Please try again later.",
+    "209": "The VAT ID does not comply with the VAT ID syntax of the respective EU member country.",
+    "210": "The VAT ID does not pass the checksum rules of the respective EU member country.",
+    "211": "The VAT ID contains illegal symbols.",
+    "212": "The VAT ID contains an unknown country code",
+    "213": "Verifying a German VAT ID is not possible.",
+    "214": "The German VAT ID is malformed.",
+    "215": "Either one of the two VAT IDs is missing.",
+    "216": (
+        "Ihre Anfrage enthält nicht alle notwendigen Angaben für eine"
+        " qualifizierte Bestätigungsanfrage (Ihre deutsche USt-IdNr., die ausl."
+        " USt-IdNr., Firmenname einschl. Rechtsform und Ort). Es wurde eine"
+        " einfache Bestätigungsanfrage durchgeführt mit folgenden Ergebnis: Die"
+        " angefragte USt-IdNr. ist gültig."
+    ),
+    "217": (
+        "An error occurred while processing your VAT ID by the respective EU"
+        " member country. Please try again later."
+    ),
+    "218": (
+        "Eine qualifizierte Bestätigung ist zur Zeit nicht möglich. Es wurde"
+        " eine einfache Bestätigungsanfrage mit folgendem Ergebnis"
+        " durchgeführt: Die angefragte USt-IdNr. ist gültig."
+    ),
+    "219": (
+        "Bei der Durchführung der qualifizierten Bestätigungsanfrage ist ein"
+        " Fehler aufgetreten. Es wurde eine einfache Bestätigungsanfrage mit"
+        " folgendem Ergebnis durchgeführt: Die angefragte USt-IdNr. ist gültig."
+    ),
+    "220": "An error occurred while processing the VAT ID.",
+    "221": "The request was incomplete or contains invalid data types.",
+    "222": (
+        "Die angefragte USt-IdNr. ist gültig. Bitte beachten Sie die Umstellung"
+        " auf ausschließlich HTTPS (TLS 1.2) zum 07.01.2019."
+    ),
+    "999": "The VAT ID cannot be veryfied at this point. Please try again later.",
+}
+
+VERIFIED = "verified"
+INVALID = "invalid"
+PENDING = "pending"
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+
+class VATIDVerification(ndb.Model):
+    # Key ID is the VAT ID
+    status = ndb.StringProperty()
+    code = ndb.TextProperty()
+    message = ndb.TextProperty()
+    checked = ndb.DateTimeProperty()
+    recheckJob = ndb.TextProperty()
+
+    def current(self):
+        # Pending verifications expire like invalid ones, in case the recheck never succeeds
+        ttl = definitions.VATID_CACHE_TTL if self.status == VERIFIED else definitions.VATID_INVALID_CACHE_TTL
+        return self.checked + datetime.timedelta(seconds=ttl) > helpers.now()
+
+
+class VATXMLResponse(object):
+    def __init__(self, xml):
+        self.keys = []
+
+        root = ET.fromstring(xml)
+        values = root.findall("./param/value/array/data/value/")
+        for i in range(0, len(values), 2):
+            setattr(self, values[i].text, values[i + 1].text)
+            self.keys.append(values[i].text)
+
+    def toStr(self):
+        string = []
+        for key in self.keys:
+            string.append("%s: %s" % (key, getattr(self, key)))
+        return "\n".join(string)
+
+
+def lookup(value, timeout=None):
+    """
+    Ask the remote service about a VAT ID. Returns the parsed response.
+    Raises requests.RequestException if the service can’t be reached.
+    """
+    response = outbound.get(URL % (OWN_VATID, value), timeout=timeout)
+    if response.status_code != 200:
+        raise requests.HTTPError(f"HTTP Error {response.status_code}: {response.text}", response=response)
+    return VATXMLResponse(response.text)
+
+
+def responseText(r):
+    text = RESPONSES.get(r.ErrorCode, "The request returned an unknown response code.")
+    if "%(" in text:
+        text = text % {key: getattr(r, key, None) for key in ("Gueltig_ab", "Gueltig_bis")}
+    return text
+
+
+def record(value, r):
+    """
+    Remember the outcome of a lookup and return (valid, message) like Property.valid().
+    Temporary problems leave the VAT ID pending verification.
+    """
+    code = getattr(r, "ErrorCode", None)
+    sendEmail = code not in VALID_CODES and (code in EMAIL_FOR_CODES or code not in RESPONSES)
+
+    if sendEmail:
+        body = r.toStr() + "\n"
+        body += f"Error code {code}: {responseText(r)}"
+        helpers.email(
+            "hq@mail.type.world",
+            ["post@yanone.de"],
+            "Malformed VAT ID verification on type.world",
+            body,
+        )
+
+    if code in TEMPORARY_CODES:
+        pending(value, responseText(r))
+        return True, None
+
+    if code in VALID_CODES:
+        status, valid, message = VERIFIED, True, None
+    else:
+        status, valid, message = INVALID, False, responseText(r)
+        if sendEmail:
+            message += " The administrator has been informed by email."
+
+    if code not in UNCACHED_CODES:
+        VATIDVerification(id=value, status=status, code=code, message=message, checked=helpers.now()).put()
+
+    return valid, message
+
+
+def pending(value, reason):
+    """
+    Accept a VAT ID for now and check it again in the background
+    """
+    verification = VATIDVerification.get_by_id(value) or VATIDVerification(id=value)
+    if verification.status == PENDING and verification.recheckJob:
+        job = ndb.Key(jobs.Job, verification.recheckJob).get()
+        if job and not job.finished():
+            return
+
+    verification.status = PENDING
+    verification.message = reason
+    verification.checked = helpers.now()
+    verification.recheckJob = f"recheckVATID-{value}-{helpers.Garbage(10)}"
+    verification.put()
+    jobs.enqueue("recheckVATID", verification.recheckJob, value=value)
+
+
+def verify(value):
+    """
+    Return (valid, message) for a shaped VAT ID, from the cache if possible.
+    """
+    verification = VATIDVerification.get_by_id(value)
+    if verification and verification.current():
+        if verification.status == INVALID:
+            return False, verification.message
+        return True, None
+
+    future = _executor.submit(lookup, value, (outbound.CONNECT_TIMEOUT, definitions.VATID_LOOKUP_DEADLINE))
+    try:
+        r = future.result(timeout=definitions.VATID_LOOKUP_DEADLINE)
+    except (concurrent.futures.TimeoutError, requests.RequestException, ET.ParseError) as e:
+        pending(value, str(e) or "Timeout")
+        return True, None
+
+    return record(value, r)
+
+
+@jobs.task
+def recheckVATID(value):
+    try:
+        r = lookup(value)
+    except (requests.RequestException, ET.ParseError) as e:
+        raise jobs.Retry(definitions.VATID_RECHECK_DELAY, f"VAT ID verification unavailable: {e}")
+    if getattr(r, "ErrorCode", None) in TEMPORARY_CODES:
+        raise jobs.Retry(
+            definitions.VATID_RECHECK_DELAY, f"VAT ID verification temporarily unavailable: {responseText(r)}"
+        )
+
+    valid, message = record(value, r)
+
+    # The VAT ID has been accepted while pending verification, so someone needs to follow up on it
+    if not valid:
+        helpers.email(
+            "hq@mail.type.world",
+            ["post@yanone.de"],
+            "Invalid VAT ID accepted on type.world",
+            f"The VAT ID {value} was accepted pending verification, but turned out to be invalid:\n{message}",
+            idempotencyKey=f"invalidVATID-{value}-{helpers.now().date()}",
+        )
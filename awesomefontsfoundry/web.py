@@ -9,24 +9,31 @@ in Python code. The main purpose is to establish an easily reusable format
 for reloading the HTML content of a specific micro-view only, without reloading
 the entire page.
 
-Unbound containers are called via the container() method:
+Unbound containers are registered with the @unboundView decorator
+and called via the container() method:
 
 ```
+@unboundView
 def content_xyz():
     ...
 container('content_xyz')
 ```
 
-Class-bound containers are called via the classes’s container() method:
+Class-bound containers are marked with the @view decorator
+and called via the classes’s container() method:
 
 ```
-class ABC():
+class ABC(WebAppModel):
+    @view
     def content_xyz(self):
         ...
 abc = ABC()
 abc.container('content_xyz')
 ```
 
+Only registered functions and marked methods can be reloaded from the browser.
+Likewise, only methods marked with @action can be run through /executeMethod.
+
 
 #
 # CONTAINER REPRESENTATION IN HTML
@@ -76,35 +83,133 @@ class Translation_Category(WebAppModel):
 
 # project
 import awesomefontsfoundry
-from awesomefontsfoundry import classes, helpers
+from awesomefontsfoundry import blobs, classes, definitions, helpers, vatid
 
 # from awesomefontsfoundry import helpers
 # from awesomefontsfoundry import api
 
 # other
-import typeworld.client
 import os
 import json
 import semver
-from flask import abort, g, request, send_file
-from google.cloud.ndb.model import KeyProperty
-import google.cloud.ndb.model
-import importlib
+from flask import abort, g, has_request_context, request, Response
+from google.cloud.ndb.model import KeyProperty, _BaseValue
 import base64
 from google.cloud import ndb
-from urllib.parse import unquote, urlencode
+from urllib.parse import quote, unquote, urlencode
+import collections
 import copy
+import datetime
+import functools
+import hashlib
+import hmac
 import hotmetal
-import io
+import threading
+import types
+
+# Registries, filled at import time
+# Unbound container functions by name (see unboundView())
+UNBOUND_VIEWS = {}
+# WebAppModel subclasses by class name (see WebAppModel.__init_subclass__())
+MODELS = {}
+
+
+def unboundView(function):
+    """
+    Register a function as unbound container, reachable from the browser through /reloadContainer
+    """
+    UNBOUND_VIEWS[function.__name__] = function
+    return function
+
+
+def view(method):
+    """
+    Mark a WebAppModel method as container, reachable from the browser through /reloadContainer
+    (subject to viewPermission())
+    """
+    method.isView = True
+    return method
+
+
+def action(method):
+    """
+    Mark a WebAppModel method as reachable from the browser through /executeMethod
+    (subject to executeMethodPermission())
+    """
+    method.isAction = True
+    return method
+
+
+def cached(method):
+    """
+    Mark a WebAppModel container method for the fragment cache (see FragmentCache).
+    Its HTML may only depend on the entity, the parameters and the viewer’s role.
+    """
+    method.isCached = True
+    return method
+
+
+#####
+
+# Rendered HTML of cached container methods, shared by all requests of a process
+awesomefontsfoundry.app.config["FRAGMENT_CACHE_MAX_BYTES"] = 16 * 1024 * 1024
+
+
+class FragmentCache(object):
+    """
+    HTML fragments keyed by (entity key, touched, method, parameters, viewer role),
+    evicted least-recently-used first beyond `maxBytes`.
+    Entities get a new `touched` on every put, so their outdated fragments are never hit again.
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.size = 0
+        self.fragments = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            html = self.fragments.get(key)
+            if html is not None:
+                self.fragments.move_to_end(key)
+            return html
+
+    def set(self, key, html):
+        size = len(html.encode())
+        if size > self.maxBytes:
+            return
+        with self.lock:
+            if key in self.fragments:
+                self.size -= len(self.fragments.pop(key).encode())
+            self.fragments[key] = html
+            self.size += size
+            while self.size > self.maxBytes:
+                oldKey, oldHTML = self.fragments.popitem(last=False)
+                self.size -= len(oldHTML.encode())
+
 
-awesomefontsfoundry.app.config["modules"].append("web")
+_fragmentCache = None
+
+
+def fragmentCache():
+    global _fragmentCache
+    if _fragmentCache is None:
+        _fragmentCache = FragmentCache(awesomefontsfoundry.app.config["FRAGMENT_CACHE_MAX_BYTES"])
+    return _fragmentCache
+
+
+def viewerRole():
+    if g.get("admin"):
+        return "admin"
+    if g.get("user"):
+        return "user"
+    return "anonymous"
 
 
 #####
 
 FORM_PREFIX = "dialogform_"
-KEY_METHOD_SEPARATOR = "__---__"
-KEY_PARAMETER_SEPARATOR = "__----__"
 
 EMPTY = "__empty__"
 NOTUPDATED = "__notupdated__"
@@ -115,54 +220,198 @@ UNCHANGED = "__unchanged__"
 dataContainerJavaScriptIdentifier = "' + dataContainerJavaScriptIdentifier($(this)) + '"
 
 
-def base64_encode(string):
-    """
-    Removes any `=` used as padding from the encoded string.
-    """
-    encoded = base64.urlsafe_b64encode(string.encode()).decode()
-    return encoded.rstrip("=")
+# Data container identifiers
+#
+# An identifier is "c" followed by the URL-safe base64 encoding (without padding) of:
+#     HMAC tag (DATA_CONTAINER_TAG_LENGTH bytes) + flags + [key] + method + parameters
+# The key is stored as its flat path of (kind, ID) pairs. Kinds and methods are stored as ordinals
+# in the registries (MODELS, UNBOUND_VIEWS and the classes’ @view methods), or by name
+# if they aren’t registered. Parameters are stored as compact JSON.
+# The HMAC key depends on the registries, so identifiers from before a change of the registries
+# (e.g. from a page rendered by the previous deployment) get rejected.
+
+DATA_CONTAINER_TAG_LENGTH = 8
+DATA_CONTAINER_CACHE_SIZE = 4096
+BOUND = 1
 
 
-def base64_decode(string):
+class InvalidDataContainer(ValueError):
+    pass
+
+
+_dataContainerRegistry = None
+
+
+def dataContainerRegistry():
     """
-    Adds back in the required padding before decoding.
+    Ordinals of kinds and methods, and the HMAC key, built after all modules have registered
     """
-    padding = 4 - (len(string) % 4)
-    string = string + ("=" * padding)
-    return base64.urlsafe_b64decode(string.encode()).decode()
+    global _dataContainerRegistry
+    if _dataContainerRegistry is None or _dataContainerRegistry["size"] != (len(MODELS), len(UNBOUND_VIEWS)):
+        classes = {}
+        for cls in MODELS.values():
+            classes[cls._get_kind()] = cls
+        kinds = sorted(classes)
+        unboundViews = sorted(UNBOUND_VIEWS)
+        views = {kind: sorted(classes[kind]._views) for kind in kinds}
+
+        layout = json.dumps([kinds, unboundViews, [views[kind] for kind in kinds]]).encode()
+        secretKey = awesomefontsfoundry.app.secret_key
+        if isinstance(secretKey, str):
+            secretKey = secretKey.encode()
+
+        _dataContainerRegistry = {
+            "size": (len(MODELS), len(UNBOUND_VIEWS)),
+            "kinds": kinds,
+            "kindOrdinals": {kind: i for i, kind in enumerate(kinds)},
+            "unboundViews": unboundViews,
+            "unboundViewOrdinals": {name: i for i, name in enumerate(unboundViews)},
+            "views": views,
+            "viewOrdinals": {kind: {name: i for i, name in enumerate(views[kind])} for kind in kinds},
+            "hmacKey": hmac.new(secretKey, b"dataContainer" + layout, hashlib.sha256).digest(),
+        }
+    return _dataContainerRegistry
+
+
+def _varint(number):
+    data = bytearray()
+    while True:
+        byte = number & 0x7F
+        number >>= 7
+        if number:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+
+def _readVarint(data, position):
+    number = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise InvalidDataContainer("Truncated")
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return number, position
+
+
+def _string(string):
+    data = string.encode()
+    return _varint(len(data)) + data
+
+
+def _readString(data, position):
+    length, position = _readVarint(data, position)
+    if position + length > len(data):
+        raise InvalidDataContainer("Truncated")
+    return data[position : position + length].decode(), position + length  # noqa E203
+
+
+def _name(name, ordinals):
+    # Ordinal + 1, or 0 followed by the name for unregistered names
+    if name in ordinals:
+        return _varint(ordinals[name] + 1)
+    return _varint(0) + _string(name)
+
+
+def _readName(data, position, names):
+    ordinal, position = _readVarint(data, position)
+    if ordinal == 0:
+        return _readString(data, position)
+    if ordinal > len(names):
+        raise InvalidDataContainer("Unknown ordinal")
+    return names[ordinal - 1], position
+
+
+@functools.lru_cache(maxsize=DATA_CONTAINER_CACHE_SIZE)
+def _encodeDataContainer(flatKey, methodName, parameterJSON):
+    registry = dataContainerRegistry()
+
+    if flatKey:
+        body = bytearray([BOUND])
+        body += _varint(len(flatKey) // 2)
+        for kind, ID in zip(flatKey[0::2], flatKey[1::2]):
+            body += _name(kind, registry["kindOrdinals"])
+            if isinstance(ID, int):
+                body += _varint(ID << 1)
+            else:
+                data = ID.encode()
+                body += _varint(len(data) << 1 | 1) + data
+        body += _name(methodName, registry["viewOrdinals"].get(flatKey[-2], {}))
+    else:
+        body = bytearray([0])
+        body += _name(methodName, registry["unboundViewOrdinals"])
+    if parameterJSON != "{}":
+        body += parameterJSON.encode()
+
+    tag = hmac.new(registry["hmacKey"], bytes(body), hashlib.sha256).digest()[:DATA_CONTAINER_TAG_LENGTH]
+    return "c" + base64.urlsafe_b64encode(tag + body).decode().rstrip("=")
+
+
+@functools.lru_cache(maxsize=DATA_CONTAINER_CACHE_SIZE)
+def _decodeDataContainer(string):
+    registry = dataContainerRegistry()
+
+    if not string.startswith("c"):
+        raise InvalidDataContainer("Unknown format")
+    try:
+        data = base64.urlsafe_b64decode(string[1:] + "=" * (-(len(string) - 1) % 4))
+    except ValueError:
+        raise InvalidDataContainer("Invalid encoding")
+
+    tag, body = data[:DATA_CONTAINER_TAG_LENGTH], data[DATA_CONTAINER_TAG_LENGTH:]
+    expected = hmac.new(registry["hmacKey"], body, hashlib.sha256).digest()[:DATA_CONTAINER_TAG_LENGTH]
+    if not body or not hmac.compare_digest(tag, expected):
+        raise InvalidDataContainer("Invalid signature")
+
+    flatKey = None
+    position = 1
+    if body[0] & BOUND:
+        flatKey = []
+        pairs, position = _readVarint(body, position)
+        for i in range(pairs):
+            kind, position = _readName(body, position, registry["kinds"])
+            ID, position = _readVarint(body, position)
+            if ID & 1:
+                length = ID >> 1
+                ID = body[position : position + length].decode()  # noqa E203
+                position += length
+            else:
+                ID = ID >> 1
+            flatKey.extend([kind, ID])
+        flatKey = tuple(flatKey)
+        methodName, position = _readName(body, position, registry["views"].get(flatKey[-2], []))
+    else:
+        methodName, position = _readName(body, position, registry["unboundViews"])
+
+    return flatKey, methodName, body[position:].decode() or "{}"
 
 
 def encodeDataContainer(key, methodName, parameters={}):
     """
     Encode an object’s NDB key (optional for unbound methods as None),
     its method name, and a parameter dictionary
-    for output as and HTML-safe identifier.
+    for output as a compact, signed and HTML-safe identifier.
     Returns the encoded information as a single string.
     """
-    parameterString = base64_encode(json.dumps(parameters))
-
-    if key:
-        return f"{key}{KEY_METHOD_SEPARATOR}{methodName}{KEY_PARAMETER_SEPARATOR}{parameterString}"
-    else:
-        return f"{methodName}{KEY_PARAMETER_SEPARATOR}{parameterString}"
+    flatKey = key.flat() if key else None
+    return _encodeDataContainer(flatKey, methodName, json.dumps(parameters, separators=(",", ":"), sort_keys=True))
 
 
 def decodeDataContainer(string):
     """
     Inverse of encodeDataContainer().
-    Returns (keyID, methodName, parameters) tuple,
-    with keyID being None for unbound methods.
+    Returns (key, methodName, parameters) tuple,
+    with key being None for unbound methods.
+    Raises InvalidDataContainer for malformed or tampered identifiers.
     """
-    ID, parameterB64 = string.split(KEY_PARAMETER_SEPARATOR)
-    if KEY_METHOD_SEPARATOR in ID:
-        keyID, methodName = ID.split(KEY_METHOD_SEPARATOR)
-    else:
-        keyID = None
-        methodName = ID
-
-    parameters = json.loads(base64_decode(parameterB64))
-
-    return keyID, methodName, parameters
+    flatKey, methodName, parameterJSON = _decodeDataContainer(string)
+    key = ndb.Key(*flatKey) if flatKey else None
+    return key, methodName, json.loads(parameterJSON)
 
 
 def reload(text="↻", style="text", parameters={}, backgroundColor=None):
@@ -202,26 +451,7 @@ def outerContainer(methodName, parameters, inline):
 
 
 def innerContainer(methodName, parameters={}, directCallParameters={}):
-    method = None
-
-    for moduleName in awesomefontsfoundry.app.config["modules"]:
-        if moduleName == "__main__":
-            module = importlib.import_module(moduleName, package=None)
-        else:
-            module = importlib.import_module("awesomefontsfoundry." + moduleName, package=None)
-        if hasattr(module, methodName):
-            method = getattr(module, methodName)
-            break
-
-    assert method
-
-    if methodName in globals():
-        method = globals()[methodName]
-    elif methodName in locals():
-        method = locals()[methodName]
-
-    if method:
-        method(parameters, directCallParameters)
+    UNBOUND_VIEWS[methodName](parameters, directCallParameters)
 
 
 def _outerContainer():
@@ -343,6 +573,29 @@ class FileProperty(ndb.PickleProperty, Property):
             }
 
 
+class ChunkedFileProperty(FileProperty):
+    """
+    File whose content lives in the blob store (see blobs.py).
+    The entity only keeps a small reference: {"filename", "hash", "size", "format"}.
+    Uploaded content is moved to the blob store when the entity is put.
+    Legacy values holding the whole file in "stream" remain readable
+    and get moved on their next put.
+    """
+
+    def _from_base_type(self, value):
+        if isinstance(value, dict) and "stream" in value and "format" not in value:
+            value["size"] = len(value["stream"])
+            value["format"] = blobs.fileFormat(value["filename"])
+            return value
+
+    def _prepare_for_put(self, entity):
+        value = self._get_user_value(entity)
+        if value and "stream" in value:
+            file = blobs.storeFile(value["filename"], value["stream"])
+            self._set_value(entity, file)
+            blobs.base64Cache().populate(file)
+
+
 class TextProperty(ndb.TextProperty, Property):
     def dialog(self, key, value, placeholder=None):
         g.html.textInput(key, value=value, type="textarea", placeholder=placeholder)
@@ -353,7 +606,7 @@ class EmailProperty(ndb.StringProperty, Property):
         g.html.textInput(key, value=value, type="email", placeholder=placeholder)
 
     def valid(self, value):
-        if api.verifyEmail(value):
+        if helpers.verifyEmail(value):
             return True, None
         else:
             return False, "Invalid email"
@@ -505,114 +758,8 @@ class EUVATIDProperty(ndb.StringProperty, Property):
             return False, "EU VAT ID and Country mismatch"
         if g.form._get("invoiceCountry") == "DE":
             return False, "No VAT ID needed for companies in Germany"
-        # Shape
         # Validate
-        url = "https://evatr.bff-online.de/evatrRPC?UstId_1=DE212651941&UstId_2=%s" % (value)
-        success, responseContent, response = typeworld.client.request(url)
-        if type(responseContent) != str:
-            responseContent = responseContent.decode()
-        if not success:
-            return False, responseContent
-
-        class VATXMLResponse(object):
-            def __init__(self, xml):
-                self.keys = []
-                import xml.etree.ElementTree as ET
-
-                root = ET.fromstring(xml)
-                values = root.findall("./param/value/array/data/value/")
-                for i in range(0, len(values), 2):
-                    setattr(self, values[i].text, values[i + 1].text)
-                    self.keys.append(values[i].text)
-
-            def toStr(self):
-                string = []
-                for key in self.keys:
-                    string.append("%s: %s" % (key, getattr(self, key)))
-                return "\n".join(string)
-
-        r = VATXMLResponse(responseContent)
-        valid = ("200", "216", "218", "219", "222")
-        emailForCodes = ("200", "205", "206", "207", "214", "215", "217", "220", "999")
-        if r.ErrorCode in valid:
-            return True, None
-        # https://evatr.bff-online.de/eVatR/xmlrpc/codes
-
-        responses = {
-            "200": "Die angefragte USt-IdNr. ist gültig.",
-            "201": "The VAT ID is invalid.",
-            "202": (
-                "The VAT ID is invalid. It is not registered in the business database"
-                " of the respective EU member country. You may have to apply with your"
-                " finance authorities to have your number registered in the respective"
-                " database."
-            ),
-            "203": "The VAT ID is valid only starting %s." % (r.Gueltig_ab),
-            "204": "The VAT ID was valid only between %s and %s." % (r.Gueltig_ab, r.Gueltig_bis),
-            "205": "The request can’t be processed at the moment. Please try again later.",
-            "206": "The German VAT ID of the seller is invalid.",
-            "207": "The German VAT ID is not authorized to request VAT ID verifications.",
-            "208": "Another request is currently running for this VAT ID. Please try again later.",
-            "209": "The VAT ID does not comply with the VAT ID syntax of the respective EU member country.",
-            "210": "The VAT ID does not pass the checksum rules of the respective EU member country.",
-            "211": "The VAT ID contains illegal symbols.",
-            "212": "The VAT ID contains an unknown country code",
-            "213": "Verifying a German VAT ID is not possible.",
-            "214": "The German VAT ID is malformed.",
-            "215": "Either one of the two VAT IDs is missing.",
-            "216": (
-                "Ihre Anfrage enthält nicht alle notwendigen Angaben für eine"
-                " qualifizierte Bestätigungsanfrage (Ihre deutsche USt-IdNr., die ausl."
-                " USt-IdNr., Firmenname einschl. Rechtsform und Ort). Es wurde eine"
-                " einfache Bestätigungsanfrage durchgeführt mit folgenden Ergebnis: Die"
-                " angefragte USt-IdNr. ist gültig."
-            ),
-            "217": (
-                "An error occurred while processing your VAT ID by the respective EU"
-                " member country. Please try again later."
-            ),
-            "218": (
-                "Eine qualifizierte Bestätigung ist zur Zeit nicht möglich. Es wurde"
-                " eine einfache Bestätigungsanfrage mit folgendem Ergebnis"
-                " durchgeführt: Die angefragte USt-IdNr. ist gültig."
-            ),
-            "219": (
-                "Bei der Durchführung der qualifizierten Bestätigungsanfrage ist ein"
-                " Fehler aufgetreten. Es wurde eine einfache Bestätigungsanfrage mit"
-                " folgendem Ergebnis durchgeführt: Die angefragte USt-IdNr. ist gültig."
-            ),
-            "220": "An error occurred while processing the VAT ID.",
-            "221": "The request was incomplete or contains invalid data types.",
-            "222": (
-                "Die angefragte USt-IdNr. ist gültig. Bitte beachten Sie die Umstellung"
-                " auf ausschließlich HTTPS (TLS 1.2) zum 07.01.2019."
-            ),
-            "999": "The VAT ID cannot be veryfied at this point. Please try again later.",
-        }
-        sendEmail = False
-        responseText = ""
-
-        if r.ErrorCode in responses:
-            responseText = responses[r.ErrorCode]
-            if r.ErrorCode in emailForCodes:
-                sendEmail = True
-        else:
-            responseText = "The request returned an unknown response code."
-            sendEmail = True
-
-        # Send email
-        if sendEmail:
-            responseText += " The administrator has been informed by email."
-            body = r.toStr() + "\n"
-            body += f"Error code {r.ErrorCode}: {responseText}"
-            helpers.email(
-                "hq@mail.type.world",
-                "post@yanone.de",
-                "Malformed VAT ID verification on type.world",
-                body,
-            )
-
-        return False, responseText
+        return vatid.verify(value)
 
 
 class ChoicesProperty(ndb.StringProperty, Property):
@@ -658,6 +805,58 @@ class ChoicesProperty(ndb.StringProperty, Property):
         g.html._DIV()
 
 
+class Undecoded(object):
+    """
+    A property value in its stored form, as loaded from the Datastore
+    """
+
+    def __init__(self, value):
+        self.value = value
+        # ndb decodes repeated values in place, so remember the items
+        self.items = list(value) if isinstance(value, list) else None
+
+    def unchanged(self, value):
+        if self.items is not None:
+            return (
+                value is self.value
+                and len(value) == len(self.items)
+                and all([a is b for a, b in zip(value, self.items)])
+            )
+        return value is self.value
+
+
+IMMUTABLE_TYPES = (
+    type(None),
+    bool,
+    int,
+    float,
+    complex,
+    str,
+    bytes,
+    datetime.datetime,
+    datetime.date,
+    datetime.time,
+    ndb.Key,
+)
+
+
+def fingerprint(value):
+    """
+    Cheap snapshot of a property value for change detection.
+    Containers get copied structurally, immutable values (including large bytes) are kept by reference.
+    Other objects fall back to a deep copy.
+    """
+    if isinstance(value, IMMUTABLE_TYPES):
+        return value
+    if isinstance(value, dict):
+        return (dict, tuple([(k, fingerprint(v)) for k, v in value.items()]))
+    if isinstance(value, (list, tuple)):
+        return (type(value), tuple([fingerprint(x) for x in value]))
+    if isinstance(value, (set, frozenset)):
+        return (type(value), frozenset(value))
+    return copy.deepcopy(value)
+
+
 # class WebAppModelDelegate(object):
 #     def before__init__(self):
 #         pass
@@ -665,6 +864,12 @@ class ChoicesProperty(ndb.StringProperty, Property):
 #         pass
 
 
+# Entry of a model class’s property registry (see WebAppModel.__init_subclass__())
+PropertyInfo = collections.namedtuple(
+    "PropertyInfo", ("name", "property", "shape", "valid", "dialog", "required", "verboseName")
+)
+
+
 class WebAppModel(ndb.Model):
 
     created = DateTimeProperty()
@@ -672,6 +877,52 @@ class WebAppModel(ndb.Model):
     touched = DateTimeProperty(auto_now=True)
     defaultValues = {}
 
+    # Names of methods marked with @view, @action and @cached, computed once per class
+    _views = frozenset()
+    _actions = frozenset()
+    _cachedViews = frozenset()
+
+    # Property registry, computed once per class:
+    # Properties declared on the class itself, in order of declaration (edited in dialogs, tracked for changes)
+    _propertyRegistry = ()
+    # All properties including inherited ones, by name
+    _propertyRegistryByName = types.MappingProxyType({})
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+
+        byName = {}
+        views = set()
+        actions = set()
+        cachedViews = set()
+        for klass in reversed(cls.__mro__):
+            for key, attr in klass.__dict__.items():
+                views.discard(key)
+                actions.discard(key)
+                cachedViews.discard(key)
+                if getattr(attr, "isView", False):
+                    views.add(key)
+                if getattr(attr, "isAction", False):
+                    actions.add(key)
+                if getattr(attr, "isCached", False):
+                    cachedViews.add(key)
+
+                if isinstance(attr, Property):
+                    byName[key] = PropertyInfo(
+                        key, attr, attr.shape, attr.valid, attr.dialog, attr._required, attr._verbose_name
+                    )
+                elif key in byName:
+                    del byName[key]
+
+        cls._propertyRegistry = tuple([byName[key] for key in cls.__dict__ if key in byName])
+        cls._propertyRegistryByName = types.MappingProxyType(byName)
+
+        cls._views = frozenset(views)
+        cls._actions = frozenset(actions)
+        cls._cachedViews = frozenset(cachedViews)
+
+        MODELS[cls.__name__] = cls
+
     def __init__(self, *args, **kwargs):
         # print(self.__class__.__name__, "__init__")
         self.delegate = None
@@ -696,6 +947,14 @@ class WebAppModel(ndb.Model):
     # def beforeDelete(self):
     #     pass
 
+    @classmethod
+    def getMulti(cls, keys, **kwargs):
+        """
+        Fetch entities for a list of keys concurrently in a single batch.
+        Keys of entities that don’t exist (anymore) are skipped.
+        """
+        return [x for x in ndb.get_multi(keys, **kwargs) if x is not None]
+
     def downloadLink(self, propertyName):
         return (
             f"/downloadItemProperty?class={self.__class__.__name__}&key={self.publicID()}&propertyName={propertyName}"
@@ -727,19 +986,16 @@ class WebAppModel(ndb.Model):
         if self.created is None:
             self.created = helpers.now()
 
-        if self.createdBy is None and g.user:
+        if self.createdBy is None and has_request_context() and g.get("user"):
             self.createdBy = g.user.key
 
         self._currentlyPutting = True
 
         # Calculate changed properties
         if self._contentCacheUpdated:
-            # print("Calculate changed properties")
-            for key in self.__properties():
-                # print(f"{key}: -{getattr(self, key)}- -{self._contentCache[key]}-")
-                if getattr(self, key) != self._contentCache[key]:
-                    self._changed.append(key)
-            # print("self._changed", self._changed)
+            for info in self._propertyRegistry:
+                if info.name not in self._changed and self._propertyChanged(info):
+                    self._changed.append(info.name)
 
         self.beforePut()
 
@@ -749,50 +1005,81 @@ class WebAppModel(ndb.Model):
         self._updateContentCache()
         self._currentlyPutting = False
 
-    def put(self, **kwargs):
-
-        if self._currentlyPutting:
-            super(WebAppModel, self).put(**kwargs)
-        else:
-            self._prepareToPut()
-
-            # Actually save
-            if self._contentCacheUpdated is False or self._changed:
+    def _unitOfWorkKey(self):
+        # Entities are coalesced per key; new entities without a key by identity
+        if self.key is not None:
+            return self.key
+        return id(self)
 
-                # New behavior: Save on @awesomefontsfoundry.app.after_request
-                super(WebAppModel, self).put(**kwargs)
-                if self not in g.ndb_puts:
-                    g.ndb_puts.append(self)
+    def put(self, **kwargs):
+        """
+        Schedule the entity for writing at the end of the request (see flushPuts()).
+        Repeated calls within the same request result in a single write
+        of the entity’s final state.
+        Outside of a request, the entity is written immediately.
+        """
 
-    def putnow(self, **kwargs):
+        if not has_request_context() or g.get("ndb_puts") is None:
+            return self.putnow(**kwargs)
 
-        self.put(**kwargs)
+        # Already scheduled, will be written with its latest state
+        if g.ndb_puts.get(self._unitOfWorkKey()) is self:
+            return
 
-        # if self._currentlyPutting:
-        #     super(WebAppModel, self).put(**kwargs)
-        # else:
+        self._prepareToPut()
 
-        #     self._prepareToPut()
+        if self._contentCacheUpdated is False or self._changed:
+            g.ndb_puts[self._unitOfWorkKey()] = self
+        else:
+            self._currentlyPutting = False
 
-        #     # # Actually save
-        #     # if self._contentCacheUpdated is False or self._changed:
-        #         # Old behavior: Save immediately
-        #     super(WebAppModel, self).put(**kwargs)
-        #         # print(self.__class__.__name__, "super(WebAppModel, self).put(**kwargs)")
+    def putnow(self, **kwargs):
+        """
+        Write the entity immediately, for instance when its key is needed right away.
+        """
 
-        #     self._cleanupPut()
+        if has_request_context() and g.get("ndb_puts") and g.ndb_puts.get(self._unitOfWorkKey()) is self:
+            del g.ndb_puts[self._unitOfWorkKey()]
+        else:
+            self._prepareToPut()
 
-        #     if self in g.ndb_puts:
-        #         g.ndb_puts.remove(self)
+        super(WebAppModel, self).put(**kwargs)
+        self._cleanupPut()
 
     def _updateContentCache(self):
-        # print(self.__class__.__name__, "_updateContentCache")
-
-        for key in self.__properties():
-            self._contentCache[key] = copy.deepcopy(getattr(self, key))
+        """
+        Remember the properties’ current values to detect changes in _prepareToPut().
+        Values that haven’t been decoded from the Datastore yet are remembered in their stored form
+        and don’t get decoded. Decoded values are remembered as fingerprints (see fingerprint()).
+        """
+
+        for info in self._propertyRegistry:
+            value = self._values.get(info.property._name)
+            if isinstance(value, _BaseValue) or (
+                isinstance(value, list) and value and all([isinstance(x, _BaseValue) for x in value])
+            ):
+                self._contentCache[info.name] = Undecoded(value)
+            else:
+                self._contentCache[info.name] = fingerprint(getattr(self, info.name))
         self._changed = []
         self._contentCacheUpdated = True
 
+    def _propertyChanged(self, info):
+        prop = info.property
+        cached = self._contentCache.get(info.name)
+
+        if isinstance(cached, Undecoded):
+            # Never decoded, so never changed
+            if cached.unchanged(self._values.get(prop._name)):
+                return False
+            # Decoded since, so compare with a freshly decoded copy of the stored value
+            if cached.items is not None:
+                cached = fingerprint([prop._opt_call_from_base_type(x) for x in cached.items])
+            else:
+                cached = fingerprint(prop._opt_call_from_base_type(cached.value))
+
+        return fingerprint(getattr(self, info.name)) != cached
+
     def publicID(self):
         if self.key is None:
             self.putnow()
@@ -801,20 +1088,6 @@ class WebAppModel(ndb.Model):
     def reloadDataContainer(self, view, parameters):
         return None
 
-    def __properties(self):
-
-        _p = []
-
-        for key in self.__class__.__dict__:
-            attr = getattr(self.__class__, key)
-
-            if Property in attr.__class__.__bases__ or Property in attr.__class__.__bases__[0].__bases__:
-
-                # 			if hasattr(attr, 'dialog'):# and isinstance(getattr(attr, 'dialog'), types.FunctionType):
-                _p.append(key)
-
-        return _p
-
     def editPermission(self, propertyNames=[]):
         return False
 
@@ -842,14 +1115,38 @@ class WebAppModel(ndb.Model):
             style = None
 
         g.html.DIV(
-            class_=f"dataContainer {encodeDataContainer(self.key.urlsafe().decode(), methodName, parameters)}",
+            class_=f"dataContainer {encodeDataContainer(self.key, methodName, parameters)}",
             style=style,
         )
 
     def innerContainer(self, methodName, parameters={}, directCallParameters={}):
         method = getattr(self, methodName)
-        if method:
+        if not method:
+            return
+
+        if methodName not in self._cachedViews or directCallParameters or self.key is None or self.touched is None:
             method(parameters, directCallParameters)
+            return
+
+        key = (
+            self.key.flat(),
+            self.touched,
+            methodName,
+            json.dumps(parameters, sort_keys=True),
+            viewerRole(),
+        )
+        html = fragmentCache().get(key)
+        if html is None:
+            # Render into a separate document
+            outerHTML = g.html
+            g.html = outerHTML.__class__()
+            try:
+                method(parameters, directCallParameters)
+                html = g.html.generate()
+            finally:
+                g.html = outerHTML
+            fragmentCache().set(key, html)
+        g.html.T(html)
 
     def _outerContainer(self):
         g.html._DIV()
@@ -877,7 +1174,7 @@ class WebAppModel(ndb.Model):
         g.html.DIV(class_="dialogInnerInnerWrapper")
         g.html.DIV(class_="dialogInnerInnerInnerWrapper")
 
-        visiblePropertyNames = propertyNames or self.__properties()
+        visiblePropertyNames = propertyNames or [x.name for x in self._propertyRegistry]
 
         if not new:
             hiddenValues["key"] = self.key.urlsafe().decode()
@@ -893,12 +1190,9 @@ class WebAppModel(ndb.Model):
             # setattr(self, key, values[key])
 
             # Shape values
-            if hasattr(self.__class__, key):
-                attr = getattr(self.__class__, key)
-
-                if Property in attr.__class__.__bases__ or Property in attr.__class__.__bases__[0].__bases__:
-                    value = attr.shape(values[key])
-                    setattr(self, key, value)
+            if key in self._propertyRegistryByName:
+                value = self._propertyRegistryByName[key].shape(values[key])
+                setattr(self, key, value)
 
         # Set defaultValues
         for key in self.defaultValues:
@@ -911,15 +1205,15 @@ class WebAppModel(ndb.Model):
         for propertyName in visiblePropertyNames:
             attribute = getattr(self, propertyName)
 
-            attr = getattr(self.__class__, propertyName)
+            info = self._propertyRegistryByName[propertyName]
             g.html.P()
             g.html.label(
                 propertyName,
-                attr._verbose_name or propertyName,
-                required=attr._required,
+                info.verboseName or propertyName,
+                required=info.required,
             )
             g.html.BR()
-            attr.dialog(f"{FORM_PREFIX}{propertyName}", attribute)
+            info.dialog(f"{FORM_PREFIX}{propertyName}", attribute)
             g.html._P()
 
         # Hidden fields
@@ -1075,37 +1369,41 @@ class WebAppModel(ndb.Model):
         g.html._A()
 
 
+def flushPuts():
+    """
+    Write all entities scheduled by WebAppModel.put() during this request
+    in a single batch.
+    """
+
+    if g.get("ndb_puts"):
+        entities = list(g.ndb_puts.values())
+        g.ndb_puts = {}
+        ndb.put_multi(entities)
+        for entity in entities:
+            entity._cleanupPut()
+
+
 def getClass(key, className, parentKey=None):
+    cls = MODELS.get(className)
+    if cls is None:
+        return abort(400)
+
     # Construct object
     item = None
     if key:
-        for moduleName in awesomefontsfoundry.app.config["modules"]:
-            if moduleName == "__main__":
-                module = importlib.import_module(moduleName, package=None)
-            else:
-                module = importlib.import_module("awesomefontsfoundry." + moduleName, package=None)
-            if hasattr(module, className):
-                item = ndb.Key(urlsafe=key.encode()).get(read_consistency=ndb.STRONG)
-                break
+        key = ndb.Key(urlsafe=key.encode())
+        if key.kind() != cls._get_kind():
+            return abort(400)
+        item = key.get(read_consistency=ndb.STRONG)
 
-        # new = False
     # New
     else:
-        # new = True
         if parentKey is not None:
             parentKey = ndb.Key(urlsafe=g.form._get("parentKey").encode())
-        for moduleName in awesomefontsfoundry.app.config["modules"]:
-            if moduleName == "__main__":
-                module = importlib.import_module(moduleName, package=None)
-            else:
-                module = importlib.import_module("awesomefontsfoundry." + moduleName, package=None)
-            if hasattr(module, className):
-
-                if parentKey:
-                    item = getattr(module, className)(parent=parentKey)
-                else:
-                    item = getattr(module, className)()
-                break
+        if parentKey:
+            item = cls(parent=parentKey)
+        else:
+            item = cls()
 
     return item
 
@@ -1126,15 +1424,17 @@ def createDialog():
     hiddenValues = {}
     if g.form._get("hiddenValues"):
         for key in g.form._get("hiddenValues").split(","):
-            attr = getattr(item.__class__, key)
-            value = attr.shape(g.form._get(key))
+            if key not in item._propertyRegistryByName:
+                return abort(400)
+            value = item._propertyRegistryByName[key].shape(g.form._get(key))
             setattr(item, key, value)
             hiddenValues[key] = g.form._get(key)
     values = {}
     if g.form._get("values"):
         for key in g.form._get("values").split(","):
-            attr = getattr(item.__class__, key)
-            value = attr.shape(g.form._get(key))
+            if key not in item._propertyRegistryByName:
+                return abort(400)
+            value = item._propertyRegistryByName[key].shape(g.form._get(key))
             setattr(item, key, value)
             values[key] = g.form._get(key)
 
@@ -1167,26 +1467,29 @@ def createDialog():
 
 def dataContainerReloadSpecific(dataContainer):
 
-    keyID, methodName, parameters = decodeDataContainer(dataContainer)
+    # Reject tampered identifiers before touching the Datastore
+    try:
+        key, methodName, parameters = decodeDataContainer(dataContainer)
+    except InvalidDataContainer:
+        return abort(400)
+    # Parameters supplied by the browser aren’t signed, views need to validate them
     if g.form._get("parameters"):
         parameters = json.loads(g.form._get("parameters"))
 
-    # print("dataContainerReloadSpecific", keyID, methodName, parameters)
-
     otherItem = None
 
-    if keyID:
-        key = ndb.Key(urlsafe=keyID.encode())
-
+    if key:
         # logging.warning('dataContainerReload(%s)' % [key, methodName, parameters])
 
         otherItem = key.get(read_consistency=ndb.STRONG)
         if otherItem:
-            if g.admin or otherItem.viewPermission(methodName):
+            if methodName in otherItem._views and (g.admin or otherItem.viewPermission(methodName)):
                 otherItem.innerContainer(methodName, parameters)
             else:
                 return False, "noPermission"
     else:
+        if methodName not in UNBOUND_VIEWS:
+            return False, "noPermission"
         innerContainer(methodName, parameters)
 
         # logging.warning('dataContainerReload(%s)' % [methodName, parameters])
@@ -1200,15 +1503,12 @@ def dataContainerReload(item=None):
     # logging.warning(f'g.form._get("dataContainer"): {g.form._get("dataContainer")}')
     if g.form._get("dataContainer"):
 
-        keyID, methodName, parameters = decodeDataContainer(g.form._get("dataContainer"))
+        success, message = dataContainerReloadSpecific(g.form._get("dataContainer"))
 
+        key, methodName, parameters = decodeDataContainer(g.form._get("dataContainer"))
         if g.form._get("parameters"):
             parameters = json.loads(g.form._get("parameters"))
 
-        success, message = dataContainerReloadSpecific(g.form._get("dataContainer"))
-
-        # print("dataContainerReload", keyID, methodName, parameters, success, message)
-
         if not success:
             return success, message
 
@@ -1261,7 +1561,7 @@ def executeMethod():
 
     item = getClass(g.form._get("key"), g.form._get("class"), g.form._get("parentKey"))
 
-    if not hasattr(item, g.form._get("methodName")):
+    if g.form._get("methodName") not in item._actions:
         return abort(401)
 
     # Edit permissions
@@ -1289,14 +1589,43 @@ def downloadItemProperty():
         return abort(404)
 
     file = getattr(item, g.form._get("propertyName"))
+    digest = blobs.fileHash(file)
+    size = blobs.fileSize(file)
 
-    mem = io.BytesIO()
-    mem.write(file["stream"])
-    mem.seek(0)
+    headers = {
+        "ETag": f'"{digest}"',
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+    }
 
-    return send_file(
-        mem, as_attachment=True, attachment_filename=file["filename"], mimetype="application/octet-stream"
-    )
+    # Client already has this file
+    if request.if_none_match.contains_weak(digest):
+        return Response(status=304, headers=headers)
+
+    start, end, status = 0, size, 200
+
+    # Partial content, unless If-Range names an outdated version.
+    # Files have no Last-Modified date, so a date in If-Range never matches.
+    ifRange = request.if_range
+    unconditional = ifRange.etag is None and ifRange.date is None
+    if request.range and (unconditional or ifRange.etag == digest):
+        byteRange = request.range.range_for_length(size)
+        if byteRange is None:
+            headers["Content-Range"] = f"bytes */{size}"
+            return Response(status=416, headers=headers)
+        start, end = byteRange
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+
+    headers["Content-Length"] = str(end - start)
+    headers["Content-Disposition"] = f"attachment; filename*=UTF-8''{quote(file['filename'])}"
+
+    def stream():
+        # Runs after the request has returned, so it needs its own Datastore context
+        with awesomefontsfoundry.client.context():
+            yield from blobs.iterate(file, start, end)
+
+    return Response(stream(), status=status, mimetype="application/octet-stream", headers=headers)
 
 
 @awesomefontsfoundry.app.route("/editProperties", methods=["POST"])
@@ -1327,24 +1656,16 @@ def editProperties():
                 # Shape values
                 if hasattr(item.__class__, propertyName):
                     attr = getattr(item.__class__, propertyName)
+                    info = item._propertyRegistryByName.get(propertyName)
                     value = g.form._get(propertyName)
 
-                    # print(attr.__class__.__bases__, attr.__class__.__bases__[0].__bases__)
-
-                    # if google.cloud.ndb.model.Property in attr.__class__.__bases__ or google.cloud.ndb.model.
-                    # Property in attr.__class__.__bases__[0].__bases__ or Property in attr.__class__.__bases__
-                    #  or Property in attr.__class__.__bases__[0].__bases__:
-                    if (
-                        google.cloud.ndb.model.Property in attr.__class__.__bases__[0].__bases__
-                        or Property in attr.__class__.__bases__[0].__bases__
-                        or Property in attr.__class__.__bases__
-                    ):
+                    if info:
 
                         # Shape
-                        value = attr.shape(value)
+                        value = info.shape(value)
 
                         # Validate
-                        success, message = attr.valid(value)
+                        success, message = info.valid(value)
 
                         if not success:
                             g.html.SCRIPT()